@@ -2,6 +2,7 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_required, current_user, login_user
 from extensions import db
 from models import User, AdminUser, CommunityPost, CommunityReply, DirectMessage, Notification, DiseaseReport, InventoryItem, Customer, Sale, Order, Review
+from community_routes import unindex_post
 from werkzeug.security import generate_password_hash
 from datetime import datetime, timedelta
 import json
@@ -339,6 +340,7 @@ def delete_post(post_id):
     
     db.session.delete(post)
     db.session.commit()
+    unindex_post(post_id)
     
     flash(f'Post "{title}" deleted successfully', 'success')
     return jsonify({'success': True})
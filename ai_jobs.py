@@ -0,0 +1,112 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AIJobTimeout(Exception):
+    pass
+
+
+class AIUserLimitReached(Exception):
+    """The user already has as many jobs running as allowed"""
+
+
+class AIQueueFull(Exception):
+    """Every slot in the shared pool is taken"""
+
+
+class AIJob:
+    def __init__(self, user_id, timeout):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.status = 'queued'
+        self.chunks = []
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.deadline = time.monotonic() + timeout
+
+    @property
+    def text(self):
+        return ''.join(self.chunks)
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+
+    def check_deadline(self):
+        if time.monotonic() > self.deadline:
+            raise AIJobTimeout('AI response timed out')
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'text': self.text,
+            'error': self.error
+        }
+
+
+class AIJobQueue:
+    """Runs AI requests on a bounded worker pool with per-user concurrency limits.
+
+    ``submit`` never blocks the calling request. Finished jobs are kept for
+    ``retention`` seconds so clients without a socket can poll for the result.
+    """
+
+    def __init__(self, max_workers=4, max_jobs_per_user=1, max_pending=50, timeout=60, retention=300):
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ai-job')
+        self._jobs = {}
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, fn, *args):
+        """Queue ``fn(job, *args)`` and return the job.
+
+        Raises ``AIUserLimitReached`` or ``AIQueueFull`` when the user or the
+        pool is at its limit.
+        """
+        with self._lock:
+            self._prune()
+            if self._active.get(user_id, 0) >= self.max_jobs_per_user:
+                raise AIUserLimitReached(user_id)
+            if sum(self._active.values()) >= self.max_pending:
+                raise AIQueueFull()
+            job = AIJob(user_id, self.timeout)
+            self._jobs[job.id] = job
+            self._active[user_id] = self._active.get(user_id, 0) + 1
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def _run(self, job, fn, args):
+        try:
+            job.status = 'running'
+            job.check_deadline()
+            fn(job, *args)
+            job.status = 'done'
+        except AIJobTimeout as e:
+            job.status = 'timeout'
+            job.error = str(e)
+        except Exception as e:
+            job.status = 'error'
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                remaining = self._active.get(job.user_id, 1) - 1
+                if remaining > 0:
+                    self._active[job.user_id] = remaining
+                else:
+                    self._active.pop(job.user_id, None)
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and j.finished_at < cutoff]:
+            del self._jobs[job_id]
@@ -1,16 +1,31 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, abort
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, abort, g
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import os
 from functools import wraps
-import cohere
 import uuid
 import json
 import math
+import re
+import time
 import logging
+import atexit
+import threading
+from geo import RiderIndex, encode_polyline
+from ingest import LocationBuffer
+from presence import PresenceRegistry
+from eta import ROAD_FACTOR, SpeedTracker, distance_matrix, estimate_deliveries, haversine_many
+from dispatch import assign
+from cache import TTLCache
+from ai_jobs import AIJobQueue, AIJobTimeout, AIQueueFull, AIUserLimitReached
+from search_index import InvertedIndex
+from socket_queue import message_queue_options
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -29,8 +44,21 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'max_overflow': 20
 }
 
-# SocketIO for real-time features
-socketio = SocketIO(app, cors_allowed_origins="*", manage_session=False, ping_timeout=60, ping_interval=25)
+# SocketIO for real-time features; under gunicorn, post_fork sets SOCKETIO_ASYNC_MODE from the
+# worker class (threading for gthread) and post_worker_init refuses to start on a mismatch.
+# SOCKETIO_MESSAGE_QUEUE fans emits out to clients held by other workers (see socket_queue.py).
+socketio = SocketIO(
+    app,
+    async_mode=os.environ.get('SOCKETIO_ASYNC_MODE') or None,
+    cors_allowed_origins="*",
+    manage_session=False,
+    ping_timeout=60,
+    ping_interval=25,
+    **message_queue_options(
+        os.environ.get('SOCKETIO_MESSAGE_QUEUE'),
+        channel=os.environ.get('SOCKETIO_CHANNEL', 'flask-socketio')
+    )
+)
 
 # File upload configuration
 UPLOAD_FOLDER = 'static/uploads'
@@ -38,16 +66,27 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-# Create upload folders
-os.makedirs(os.path.join(app.root_path, UPLOAD_FOLDER), exist_ok=True)
-os.makedirs(os.path.join(app.root_path, 'static/images'), exist_ok=True)
-
-# Create default profile image if it doesn't exist
-default_profile_path = os.path.join(app.root_path, 'static/images/default-profile.png')
-if not os.path.exists(default_profile_path):
-    # Create a simple 1x1 transparent PNG
-    with open(default_profile_path, 'wb') as f:
-        f.write(b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\x0bIDATx\x9cc\x00\x01\x00\x00\x05\x00\x01\x0d\n\x08\xb4\x00\x00\x00\x00IEND\xaeB`\x82')
+DEFAULT_PROFILE_PNG = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\x0bIDATx\x9cc\x00\x01\x00\x00\x05\x00\x01\x0d\n\x08\xb4\x00\x00\x00\x00IEND\xaeB`\x82'
+_static_files_ready = False
+
+def ensure_static_files():
+    """Create upload folders and the default profile image on first use rather than at import"""
+    global _static_files_ready
+    if _static_files_ready:
+        return
+    os.makedirs(os.path.join(app.root_path, UPLOAD_FOLDER), exist_ok=True)
+    os.makedirs(os.path.join(app.root_path, 'static/images'), exist_ok=True)
+    default_profile_path = os.path.join(app.root_path, 'static/images/default-profile.png')
+    if not os.path.exists(default_profile_path):
+        # A simple 1x1 transparent PNG
+        with open(default_profile_path, 'wb') as f:
+            f.write(DEFAULT_PROFILE_PNG)
+    _static_files_ready = True
+
+@app.before_request
+def _prepare_static_files():
+    if not _static_files_ready:
+        ensure_static_files()
 
 db = SQLAlchemy(app)
 
@@ -92,6 +131,10 @@ class User(db.Model):
 
 class Product(db.Model):
     __tablename__ = 'product'
+    __table_args__ = (
+        db.Index('ix_product_active_category_created', 'is_active', 'category', 'created_at'),
+        db.Index('ix_product_updated_at', 'updated_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
@@ -120,6 +163,10 @@ class Product(db.Model):
 
 class Order(db.Model):
     __tablename__ = 'order'
+    __table_args__ = (
+        db.Index('ix_order_seller_created', 'seller_id', 'created_at'),
+        db.Index('ix_order_rider_status', 'rider_id', 'status'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     rider_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -136,6 +183,7 @@ class Order(db.Model):
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed_at = db.Column(db.DateTime)
+    offered_at = db.Column(db.DateTime)  # when rider_id was last set by dispatch or a claim
     
     # Relationships
     user = db.relationship('User', foreign_keys=[user_id], backref='user_orders')
@@ -162,6 +210,9 @@ class OrderItem(db.Model):
 
 class Sale(db.Model):
     __tablename__ = 'sale'
+    __table_args__ = (
+        db.Index('ix_sale_seller_date', 'seller_id', 'sale_date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
@@ -265,6 +316,10 @@ class Comment(db.Model):
 
 class Message(db.Model):
     __tablename__ = 'message'
+    __table_args__ = (
+        db.Index('ix_message_receiver_read', 'receiver_id', 'is_read'),
+        db.Index('ix_message_pair_created', 'sender_id', 'receiver_id', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -278,8 +333,42 @@ class Message(db.Model):
     receiver = db.relationship('User', foreign_keys=[receiver_id], back_populates='received_messages')
     product = db.relationship('Product')
 
+class Conversation(db.Model):
+    __tablename__ = 'conversation'
+    __table_args__ = (
+        db.UniqueConstraint('user_a_id', 'user_b_id', name='unique_conversation_pair'),
+        db.Index('ix_conversation_user_a_last', 'user_a_id', 'last_message_at'),
+        db.Index('ix_conversation_user_b_last', 'user_b_id', 'last_message_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    # user_a_id is always the lower of the two user ids
+    user_a_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_b_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id'))
+    last_message_at = db.Column(db.DateTime, default=datetime.utcnow)
+    unread_a = db.Column(db.Integer, default=0, nullable=False)
+    unread_b = db.Column(db.Integer, default=0, nullable=False)
+    
+    # Relationships
+    user_a = db.relationship('User', foreign_keys=[user_a_id])
+    user_b = db.relationship('User', foreign_keys=[user_b_id])
+    last_message = db.relationship('Message')
+
+class UserPresence(db.Model):
+    # One row per user per worker process holding a live socket for them
+    __tablename__ = 'user_presence'
+    __table_args__ = (
+        db.Index('ix_user_presence_last_seen', 'last_seen'),
+    )
+    worker_id = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    last_seen = db.Column(db.DateTime, nullable=False)
+
 class UserLocation(db.Model):
     __tablename__ = 'user_location'
+    __table_args__ = (
+        db.Index('ix_user_location_user_time', 'user_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     latitude = db.Column(db.Float, nullable=False)
@@ -292,6 +381,9 @@ class UserLocation(db.Model):
 
 class OrderTracking(db.Model):
     __tablename__ = 'order_tracking'
+    __table_args__ = (
+        db.Index('ix_order_tracking_order_time', 'order_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
     rider_lat = db.Column(db.Float)
@@ -303,6 +395,18 @@ class OrderTracking(db.Model):
     # Relationships
     order = db.relationship('Order', back_populates='tracking')
 
+class OrderTrackArchive(db.Model):
+    __tablename__ = 'order_track_archive'
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), unique=True, nullable=False)
+    polyline = db.Column(db.Text, nullable=False, default='')
+    offsets = db.Column(db.Text, nullable=False, default='[]')  # JSON seconds between kept points
+    events = db.Column(db.Text, nullable=False, default='[]')  # JSON status/message rows
+    point_count = db.Column(db.Integer, default=0, nullable=False)  # points before thinning
+    started_at = db.Column(db.DateTime)
+    ended_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class VideoCall(db.Model):
     __tablename__ = 'video_call'
     id = db.Column(db.Integer, primary_key=True)
@@ -337,6 +441,9 @@ class VideoCallMessage(db.Model):
 
 class InventoryLog(db.Model):
     __tablename__ = 'inventory_log'
+    __table_args__ = (
+        db.Index('ix_inventory_log_seller_created', 'seller_id', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -368,6 +475,35 @@ class ProductInquiry(db.Model):
     buyer = db.relationship('User', foreign_keys=[buyer_id], back_populates='product_inquiries')
     seller = db.relationship('User', foreign_keys=[seller_id], back_populates='received_inquiries')
 
+class SellerMetrics(db.Model):
+    __tablename__ = 'seller_metrics'
+    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    total_sales = db.Column(db.Float, default=0, nullable=False)
+    total_units = db.Column(db.Integer, default=0, nullable=False)
+    unread_messages = db.Column(db.Integer, default=0, nullable=False)
+    pending_inquiries = db.Column(db.Integer, default=0, nullable=False)
+    rebuilt_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SellerDailySales(db.Model):
+    __tablename__ = 'seller_daily_sales'
+    __table_args__ = (db.UniqueConstraint('seller_id', 'day', name='unique_seller_day'),)
+    id = db.Column(db.Integer, primary_key=True)
+    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    total_sales = db.Column(db.Float, default=0, nullable=False)
+    total_units = db.Column(db.Integer, default=0, nullable=False)
+    sale_count = db.Column(db.Integer, default=0, nullable=False)
+
+class ProductSalesTotal(db.Model):
+    __tablename__ = 'product_sales_total'
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    quantity_sold = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+    
+    # Relationships
+    product = db.relationship('Product')
+
 class RiderRecommendation(db.Model):
     __tablename__ = 'rider_recommendation'
     id = db.Column(db.Integer, primary_key=True)
@@ -384,12 +520,140 @@ class RiderRecommendation(db.Model):
     seller = db.relationship('User', foreign_keys=[seller_id], back_populates='received_recommendations')
     recommended_rider = db.relationship('User', foreign_keys=[recommended_rider_id])
 
-# Initialize Cohere
+# Cohere is imported and its client built on first use, keeping both off worker boot
 cohere_api_key = os.environ.get('COHERE_API_KEY')
-co = cohere.Client(cohere_api_key) if cohere_api_key else None
+AI_TIMEOUT_SECONDS = float(os.environ.get('AI_TIMEOUT_SECONDS', 60))
+_ai_client = None
+_ai_client_lock = threading.Lock()
+
+def get_ai_client():
+    """Shared Cohere client, or None when no API key is configured"""
+    global _ai_client
+    if _ai_client is None and cohere_api_key:
+        with _ai_client_lock:
+            if _ai_client is None:
+                import cohere
+                _ai_client = cohere.Client(cohere_api_key, timeout=AI_TIMEOUT_SECONDS)
+    return _ai_client
+
+# AI requests run off the request thread so slow responses don't hold a web worker
+ai_jobs = AIJobQueue(
+    max_workers=int(os.environ.get('AI_MAX_WORKERS', 4)),
+    max_jobs_per_user=int(os.environ.get('AI_MAX_JOBS_PER_USER', 1)),
+    max_pending=int(os.environ.get('AI_MAX_PENDING', 50)),
+    timeout=AI_TIMEOUT_SECONDS
+)
+# Retry-After sent when the shared pool is saturated
+AI_RETRY_AFTER_SECONDS = int(os.environ.get('AI_RETRY_AFTER_SECONDS', 10))
+
+# Canned questions offered on the assistant page; only these are answered from the cache
+AI_SUGGESTIONS = [
+    "What are today's specials?",
+    "How do I track my order?",
+    "What payment methods do you accept?",
+    "How do I become a seller?",
+    "Tell me about your delivery policy",
+    "Do you have any discounts?"
+]
+ai_response_cache = TTLCache(
+    maxsize=int(os.environ.get('AI_CACHE_SIZE', 256)),
+    ttl=int(os.environ.get('AI_CACHE_TTL_SECONDS', 3600))
+)
+marketplace_stats_cache = TTLCache(maxsize=1, ttl=300)
+
+# Chat history paging
+CHAT_PAGE_SIZE = 50
+CHAT_MAX_PAGE_SIZE = 100
+
+# Order tracking replay; long routes are fetched in pages of encoded points
+TRACKING_PAGE_SIZE = int(os.environ.get('TRACKING_PAGE_SIZE', 2000))
+TRACKING_POLYLINE_PRECISION = 5
+
+# Rider dispatch
+DISPATCH_RADIUS_KM = float(os.environ.get('DISPATCH_RADIUS_KM', 50))
+RIDER_INDEX_REFRESH_SECONDS = int(os.environ.get('RIDER_INDEX_REFRESH_SECONDS', 60))
+rider_index = RiderIndex()
+_rider_index_synced_at = None
+# Pending orders are matched to free riders in batches rather than claimed first-come-first-served
+DISPATCH_TICK_SECONDS = float(os.environ.get('DISPATCH_TICK_SECONDS', 10))
+DISPATCH_MAX_ORDERS = int(os.environ.get('DISPATCH_MAX_ORDERS', 500))
+RIDER_MAX_ACTIVE_ORDERS = int(os.environ.get('RIDER_MAX_ACTIVE_ORDERS', 1))
+DISPATCH_CANDIDATES_PER_ORDER = int(os.environ.get('DISPATCH_CANDIDATES_PER_ORDER', 5))
+# Offers the rider has not accepted by then go back to the pool
+DISPATCH_OFFER_TIMEOUT_SECONDS = float(os.environ.get('DISPATCH_OFFER_TIMEOUT_SECONDS', 120))
+# Advisory lock id so only one worker runs a batch at a time on PostgreSQL
+DISPATCH_LOCK_KEY = 250125
+_dispatcher_started = False
+
+# Product search
+PRODUCTS_PER_PAGE = 24
+PRODUCTS_MAX_PAGE_SIZE = 100
+PRODUCT_INDEX_REFRESH_SECONDS = int(os.environ.get('PRODUCT_INDEX_REFRESH_SECONDS', 30))
+product_index = InvertedIndex({'name': 3.0, 'category': 2.0, 'description': 1.0})
+_product_index_synced_at = None
+_product_index_checked_at = None
+
+# Catalog listings; seller routes invalidate locally, the TTL bounds staleness elsewhere
+catalog_cache = TTLCache(
+    maxsize=int(os.environ.get('CATALOG_CACHE_SIZE', 256)),
+    ttl=int(os.environ.get('CATALOG_CACHE_TTL_SECONDS', 60))
+)
+
+# Online rider snapshot for templates
+available_riders_cache = TTLCache(maxsize=1, ttl=int(os.environ.get('AVAILABLE_RIDERS_TTL_SECONDS', 15)))
+
+# Admin statistics
+admin_stats_cache = TTLCache(maxsize=1, ttl=int(os.environ.get('ADMIN_STATS_TTL_SECONDS', 30)))
+
+# Rider location ingestion
+LOCATION_FLUSH_SECONDS = float(os.environ.get('LOCATION_FLUSH_SECONDS', 5))
+location_buffer = LocationBuffer(
+    min_distance_m=float(os.environ.get('LOCATION_MIN_DISTANCE_M', 10)),
+    min_interval_s=float(os.environ.get('LOCATION_MIN_INTERVAL_SECONDS', 15)),
+    max_pending=int(os.environ.get('LOCATION_MAX_PENDING', 5000))
+)
+_location_flusher_started = False
+
+# Delivery ETAs; recomputed for every active order once per tick rather than per request
+ETA_TICK_SECONDS = float(os.environ.get('ETA_TICK_SECONDS', 15))
+RIDER_DEFAULT_SPEED_KMH = float(os.environ.get('RIDER_DEFAULT_SPEED_KMH', 20))
+ACTIVE_ORDER_STATUSES = ('pending', 'in_transit')
+rider_speeds = SpeedTracker()
+delivery_etas = {}
+_etas_computed_at = None
+_eta_ticker_started = False
+
+# Presence; socket connects/disconnects stay in memory and are written back in batches
+PRESENCE_TTL_SECONDS = int(os.environ.get('PRESENCE_TTL_SECONDS', 90))
+PRESENCE_FLUSH_SECONDS = float(os.environ.get('PRESENCE_FLUSH_SECONDS', 30))
+PRESENCE_SYNC_SECONDS = float(os.environ.get('PRESENCE_SYNC_SECONDS', 15))
+presence = PresenceRegistry(ttl=PRESENCE_TTL_SECONDS)
+_presence_synced_at = None
+_presence_worker_id = None
+_presence_flusher_started = False
 
 # ===== HELPER FUNCTIONS =====
 
+def get_current_user():
+    """Return the logged-in User, loading it at most once per request"""
+    if 'user_id' not in session:
+        return None
+    if 'current_user' not in g:
+        g.current_user = User.query.get(session['user_id'])
+    return g.current_user
+
+def get_available_riders():
+    """Short-lived snapshot of online riders shared by every template render"""
+    def load():
+        online = get_presence().online_ids('rider')
+        if not online:
+            return []
+        return db.session.query(
+            User.id, User.username, User.profile_image, User.phone_number,
+            User.whatsapp_number, User.location, User.latitude, User.longitude
+        ).filter(User.role == 'rider', User.id.in_(online)).limit(5).all()
+    return available_riders_cache.get_or_set('riders', load)
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -408,7 +672,7 @@ def role_required(role):
         def decorated_function(*args, **kwargs):
             if 'user_id' not in session:
                 return redirect(url_for('login'))
-            user = User.query.get(session['user_id'])
+            user = get_current_user()
             if not user or (user.role != role and user.role != 'admin'):
                 flash('Access denied.', 'danger')
                 return redirect(url_for('index'))
@@ -423,14 +687,169 @@ def calculate_price_with_fees(base_price):
     final_price = round(base_price + rider_fee + platform_fee, 2)
     return final_price, rider_fee, platform_fee
 
-def find_nearest_rider(location):
-    try:
-        riders = User.query.filter_by(role='rider', is_online=True).all()
-        if not riders:
-            return None
-        return riders[0] if riders else None
-    except:
-        return None
+def index_product(product):
+    """Add, refresh or drop one product in the search index"""
+    if product.is_active:
+        product_index.add(
+            product.id,
+            {'name': product.name, 'category': product.category, 'description': product.description},
+            category=product.category,
+            seller_id=product.seller_id,
+            sort_key=product.created_at.timestamp() if product.created_at else 0
+        )
+    else:
+        product_index.remove(product.id)
+
+def get_product_index():
+    """Return the product search index, applying rows changed since the last sync"""
+    global _product_index_synced_at, _product_index_checked_at
+    now = time.monotonic()
+    if _product_index_checked_at is not None and now - _product_index_checked_at < PRODUCT_INDEX_REFRESH_SECONDS:
+        return product_index
+    
+    synced_at = datetime.utcnow()
+    query = Product.query.options(db.load_only(
+        Product.id, Product.name, Product.description, Product.category,
+        Product.seller_id, Product.created_at, Product.is_active
+    ))
+    if _product_index_synced_at is None:
+        query = query.filter_by(is_active=True)
+    else:
+        # A little overlap covers clock skew between workers writing updated_at
+        query = query.filter(Product.updated_at >= _product_index_synced_at - timedelta(seconds=5))
+    for product in query:
+        index_product(product)
+    
+    _product_index_synced_at = synced_at
+    _product_index_checked_at = now
+    return product_index
+
+def invalidate_catalog():
+    """Drop cached listings and pages after a seller changes the catalog"""
+    catalog_cache.clear()
+
+def cached_product_ids(key, query):
+    """Ids for a product listing query, served from the catalog cache"""
+    return catalog_cache.get_or_set(key, lambda: [product_id for (product_id,) in query.with_entities(Product.id)])
+
+def load_products(ids):
+    """Load products by id in one query, keeping the given order"""
+    if not ids:
+        return []
+    found = {product.id: product for product in Product.query.filter(Product.id.in_(ids)).all()}
+    return [found[i] for i in ids if i in found and found[i].is_active]
+
+def decode_offset_cursor(cursor):
+    """Result offset from a search cursor ("@<n>"); raises ValueError if it is malformed"""
+    offset = int(cursor.lstrip('@'))
+    if offset < 0:
+        raise ValueError(cursor)
+    return offset
+
+def list_products(category=None, search=None, seller_id=None, cursor=None, limit=PRODUCTS_PER_PAGE):
+    """One page of the active catalog as (products, next_cursor, total).
+    
+    Listings are keyset-paginated newest first on (created_at, id). Searches
+    are ranked by relevance, so their cursor is an offset into the results.
+    """
+    limit = max(1, min(limit, PRODUCTS_MAX_PAGE_SIZE))
+    
+    if search:
+        offset = decode_offset_cursor(cursor) if cursor else 0
+        
+        def matches(meta):
+            return (not category or meta['category'] == category) and (not seller_id or meta['seller_id'] == seller_id)
+        
+        total, ids = get_product_index().search(search, limit=limit, offset=offset, where=matches)
+        next_cursor = f"@{offset + limit}" if offset + limit < total else None
+        return load_products(ids), next_cursor, total
+    
+    def page_ids():
+        query = Product.query.filter_by(is_active=True)
+        if category:
+            query = query.filter_by(category=category)
+        if seller_id:
+            query = query.filter_by(seller_id=seller_id)
+        if cursor:
+            created_at, product_id = decode_cursor(cursor)
+            query = query.filter(
+                (Product.created_at < created_at) |
+                ((Product.created_at == created_at) & (Product.id < product_id))
+            )
+        rows = query.with_entities(Product.id, Product.created_at).order_by(
+            Product.created_at.desc(), Product.id.desc()
+        ).limit(limit + 1).all()
+        next_cursor = encode_cursor(rows[limit - 1].created_at, rows[limit - 1].id) if len(rows) > limit else None
+        return [row.id for row in rows[:limit]], next_cursor
+    
+    ids, next_cursor = catalog_cache.get_or_set(('listing', category, seller_id, cursor, limit), page_ids)
+    return load_products(ids), next_cursor, None
+
+def cached_page(key, render):
+    """Serve a rendered page from the catalog cache to anonymous visitors.
+    
+    ``key`` should hold only the route and the parameters the view reads, so
+    junk query strings share an entry instead of pushing real pages out.
+    """
+    if 'user_id' in session or '_flashes' in session:
+        return render()
+    html = catalog_cache.get(('page', key))
+    if html is None:
+        html = catalog_cache.set(('page', key), render())
+    return html
+
+def get_rider_index():
+    """Return the rider spatial index, re-syncing it from the database periodically"""
+    global _rider_index_synced_at
+    now = time.monotonic()
+    if _rider_index_synced_at is None or now - _rider_index_synced_at > RIDER_INDEX_REFRESH_SECONDS:
+        # Other workers receive their own pings, so pick up their riders on a timer
+        positions = db.session.query(User.id, User.latitude, User.longitude).filter(
+            User.role == 'rider',
+            User.id.in_(get_presence().online_ids('rider')),
+            User.latitude.isnot(None),
+            User.longitude.isnot(None)
+        ).all()
+        rider_index.rebuild(positions)
+        _rider_index_synced_at = now
+    return rider_index
+
+def price_cart(cart, require_stock=False, lock=False):
+    """Load every product in a session cart with one query and compute order totals"""
+    quantities = {int(product_id): quantity for product_id, quantity in cart.items()}
+    query = Product.query.filter(Product.id.in_(quantities.keys()))
+    if lock:
+        query = query.with_for_update()
+    products_by_id = {product.id: product for product in query.all()} if quantities else {}
+    
+    items = []
+    sellers = set()
+    subtotal = 0
+    for product_id, quantity in quantities.items():
+        product = products_by_id.get(product_id)
+        if not product or not product.is_active:
+            continue
+        if require_stock and product.stock < quantity:
+            continue
+        items.append({
+            'product': product,
+            'quantity': quantity,
+            'price': product.price,
+            'seller_price': product.base_price
+        })
+        sellers.add(product.seller_id)
+        subtotal += product.price * quantity
+    
+    rider_fee = subtotal * 0.10
+    platform_fee = subtotal * 0.10
+    return {
+        'items': items,
+        'sellers': sellers,
+        'subtotal': subtotal,
+        'rider_fee': rider_fee,
+        'platform_fee': platform_fee,
+        'total': subtotal + rider_fee + platform_fee
+    }
 
 def log_inventory_change(product_id, seller_id, previous_stock, new_stock, reason, reference_id=None):
     try:
@@ -449,6 +868,586 @@ def log_inventory_change(product_id, seller_id, previous_stock, new_stock, reaso
         db.session.rollback()
         logger.error(f"Inventory log error: {e}")
 
+def record_conversation_message(msg):
+    """Update the conversation summary for a flushed Message"""
+    sender_id, receiver_id = int(msg.sender_id), int(msg.receiver_id)
+    user_a_id, user_b_id = min(sender_id, receiver_id), max(sender_id, receiver_id)
+    
+    query = Conversation.query.filter_by(user_a_id=user_a_id, user_b_id=user_b_id).with_for_update()
+    conversation = query.first()
+    if not conversation:
+        # Both parties may open the conversation at once; the loser of the insert reuses the winner's row
+        try:
+            with db.session.begin_nested():
+                db.session.add(Conversation(user_a_id=user_a_id, user_b_id=user_b_id, unread_a=0, unread_b=0))
+        except IntegrityError:
+            pass
+        conversation = query.first()
+    
+    conversation.last_message_id = msg.id
+    conversation.last_message_at = msg.created_at
+    if sender_id != receiver_id:
+        adjust_seller_metrics(receiver_id, unread_messages=1)
+        if receiver_id == user_a_id:
+            conversation.unread_a = Conversation.unread_a + 1
+        else:
+            conversation.unread_b = Conversation.unread_b + 1
+    return conversation
+
+def mark_conversation_read(user_id, partner_id):
+    """Reset the unread counter on the user's side of a conversation"""
+    user_a_id, user_b_id = min(user_id, partner_id), max(user_id, partner_id)
+    column = 'unread_a' if user_id == user_a_id else 'unread_b'
+    Conversation.query.filter_by(user_a_id=user_a_id, user_b_id=user_b_id).update({column: 0}, synchronize_session=False)
+
+def encode_cursor(created_at, row_id):
+    """Opaque keyset cursor for rows ordered by (created_at, id)"""
+    return f"{created_at.isoformat()}|{row_id}"
+
+def decode_cursor(cursor):
+    created_at, row_id = cursor.rsplit('|', 1)
+    return datetime.fromisoformat(created_at), int(row_id)
+
+def can_track_order(user, order):
+    """Admins and the order's buyer, seller and rider may follow its route"""
+    return user is not None and (user.role == 'admin' or user.id in (order.user_id, order.seller_id, order.rider_id))
+
+def fetch_message_page(user_id, partner_id, before=None, limit=CHAT_PAGE_SIZE):
+    """Return one page of a conversation, newest first, plus the cursor for the next older page"""
+    query = Message.query.filter(
+        ((Message.sender_id == user_id) & (Message.receiver_id == partner_id)) |
+        ((Message.sender_id == partner_id) & (Message.receiver_id == user_id))
+    )
+    if before:
+        created_at, message_id = decode_cursor(before)
+        query = query.filter(
+            (Message.created_at < created_at) |
+            ((Message.created_at == created_at) & (Message.id < message_id))
+        )
+    
+    page = query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(page[limit - 1].created_at, page[limit - 1].id) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+def mark_messages_read(user_id, partner_id):
+    """Mark everything the partner sent to the user as read with one UPDATE"""
+    updated = Message.query.filter_by(
+        receiver_id=user_id, sender_id=partner_id, is_read=False
+    ).update({'is_read': True})
+    if updated:
+        mark_conversation_read(user_id, partner_id)
+        adjust_seller_metrics(user_id, unread_messages=-updated)
+    return updated
+
+def conversation_summaries():
+    """Select one summary row per user pair from the message table"""
+    user_a = db.case((Message.sender_id < Message.receiver_id, Message.sender_id), else_=Message.receiver_id)
+    user_b = db.case((Message.sender_id < Message.receiver_id, Message.receiver_id), else_=Message.sender_id)
+    unread_a = db.func.sum(db.case(((Message.receiver_id == user_a) & (Message.sender_id != Message.receiver_id) & (Message.is_read == False), 1), else_=0))
+    unread_b = db.func.sum(db.case(((Message.receiver_id == user_b) & (Message.sender_id != Message.receiver_id) & (Message.is_read == False), 1), else_=0))
+    
+    return db.select(
+        user_a.label('user_a_id'),
+        user_b.label('user_b_id'),
+        db.func.max(Message.id).label('last_message_id'),
+        db.func.max(Message.created_at).label('last_message_at'),
+        unread_a.label('unread_a'),
+        unread_b.label('unread_b')
+    ).group_by(user_a, user_b)
+
+def rebuild_conversations():
+    """Recompute every conversation summary from the message table"""
+    rows = db.session.execute(conversation_summaries()).all()
+    Conversation.query.delete()
+    if rows:
+        db.session.execute(db.insert(Conversation), [row._asdict() for row in rows])
+    db.session.commit()
+    return len(rows)
+
+def flush_location_buffer():
+    """Write buffered rider positions and location history in batched statements"""
+    latest, locations, tracking = location_buffer.drain()
+    if not (latest or locations or tracking):
+        return 0
+    try:
+        if latest:
+            db.session.execute(db.update(User), [{
+                'id': rider_id,
+                'latitude': lat,
+                'longitude': lng,
+                'last_seen': timestamp
+            } for rider_id, (lat, lng, timestamp) in latest.items()])
+        if locations:
+            db.session.execute(db.insert(UserLocation), locations)
+        if tracking:
+            db.session.execute(db.insert(OrderTracking), tracking)
+        db.session.commit()
+        return len(locations) + len(tracking)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Location flush error, dropped {len(locations) + len(tracking)} rows: {e}")
+        return 0
+
+def _location_flush_loop():
+    while True:
+        socketio.sleep(LOCATION_FLUSH_SECONDS)
+        with app.app_context():
+            flush_location_buffer()
+
+def ensure_location_flusher():
+    global _location_flusher_started
+    if not _location_flusher_started:
+        _location_flusher_started = True
+        socketio.start_background_task(_location_flush_loop)
+
+def presence_worker_id():
+    """Identifies this worker process's rows in user_presence"""
+    global _presence_worker_id
+    pid = os.getpid()
+    if _presence_worker_id is None or _presence_worker_id[0] != pid:
+        _presence_worker_id = (pid, f"{pid}-{uuid.uuid4().hex[:12]}")
+    return _presence_worker_id[1]
+
+def sync_presence():
+    """Reload who is online on other workers from the presence rows they write back"""
+    global _presence_synced_at
+    cutoff = datetime.utcnow() - timedelta(seconds=PRESENCE_TTL_SECONDS)
+    rows = db.session.query(UserPresence.user_id, User.role).join(
+        User, User.id == UserPresence.user_id
+    ).filter(
+        UserPresence.worker_id != presence_worker_id(),
+        UserPresence.last_seen >= cutoff
+    ).distinct().all()
+    presence.set_remote({user_id: role for user_id, role in rows})
+    _presence_synced_at = time.monotonic()
+
+def get_presence():
+    """Return the presence registry, refreshing users held by other workers periodically"""
+    if _presence_synced_at is None or time.monotonic() - _presence_synced_at > PRESENCE_SYNC_SECONDS:
+        try:
+            sync_presence()
+        except Exception as e:
+            logger.error(f"Presence sync error: {e}")
+    return presence
+
+def _socket_connected(sid):
+    return socketio.server.manager.is_connected(sid, '/')
+
+def flush_presence():
+    """Expire dead sessions, then write this worker's presence rows and last_seen in one batch.
+    
+    Each worker only replaces its own rows, so a tab closing here never marks
+    offline a user who still has a session on another worker.
+    """
+    for user_id in presence.expire(alive=_socket_connected):
+        rider_index.remove(user_id)
+    rows = presence.drain()
+    if not rows:
+        return 0
+    worker_id = presence_worker_id()
+    try:
+        db.session.query(UserPresence).filter(
+            UserPresence.worker_id == worker_id,
+            UserPresence.user_id.in_(rows.keys())
+        ).delete(synchronize_session=False)
+        held = [{'worker_id': worker_id, 'user_id': user_id, 'last_seen': last_seen}
+                for user_id, (online, last_seen) in rows.items() if online]
+        if held:
+            db.session.execute(db.insert(UserPresence), held)
+        # Rows left behind by workers that died without cleaning up
+        db.session.query(UserPresence).filter(
+            UserPresence.last_seen < datetime.utcnow() - timedelta(seconds=PRESENCE_TTL_SECONDS)
+        ).delete(synchronize_session=False)
+        
+        db.session.execute(db.update(User), [
+            {'id': user_id, 'last_seen': last_seen} for user_id, (_, last_seen) in rows.items()
+        ])
+        # is_online mirrors whether any worker still holds a session
+        db.session.execute(db.update(User).where(User.id.in_(rows.keys())).values(
+            is_online=db.select(UserPresence.user_id).where(UserPresence.user_id == User.id).exists()
+        ).execution_options(synchronize_session=False))
+        db.session.commit()
+        sync_presence()
+        return len(rows)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Presence flush error: {e}")
+        return 0
+
+def _presence_flush_loop():
+    while True:
+        socketio.sleep(PRESENCE_FLUSH_SECONDS)
+        with app.app_context():
+            flush_presence()
+
+def ensure_presence_flusher():
+    global _presence_flusher_started
+    if not _presence_flusher_started:
+        _presence_flusher_started = True
+        socketio.start_background_task(_presence_flush_loop)
+
+def rider_position(rider_id, lat=None, lng=None):
+    """Freshest known position for a rider: an unflushed ping, else the stored one"""
+    pending = location_buffer.latest(rider_id)
+    if pending:
+        return pending[0], pending[1]
+    return (lat, lng) if lat is not None and lng is not None else None
+
+def refresh_delivery_etas():
+    """Recompute distances and ETAs for every active order in one batch"""
+    global delivery_etas, _etas_computed_at
+    seller = db.aliased(User)
+    rider = db.aliased(User)
+    rows = db.session.query(
+        Order.id, Order.rider_id, Order.status, Order.delivery_lat, Order.delivery_lng,
+        seller.latitude, seller.longitude, rider.latitude, rider.longitude
+    ).outerjoin(seller, Order.seller_id == seller.id).outerjoin(
+        rider, Order.rider_id == rider.id
+    ).filter(Order.status.in_(ACTIVE_ORDER_STATUSES)).all()
+    
+    deliveries = [{
+        'order_id': order_id,
+        'rider_id': rider_id,
+        # Riders accept straight into in_transit, so that is when the goods are on board
+        'picked_up': status == 'in_transit',
+        'rider': rider_position(rider_id, rider_lat, rider_lng) if rider_id else None,
+        'pickup': (seller_lat, seller_lng) if seller_lat is not None and seller_lng is not None else None,
+        'drop': (drop_lat, drop_lng) if drop_lat is not None and drop_lng is not None else None
+    } for order_id, rider_id, status, drop_lat, drop_lng, seller_lat, seller_lng, rider_lat, rider_lng in rows]
+    
+    delivery_etas = estimate_deliveries(deliveries, rider_speeds, datetime.utcnow(), RIDER_DEFAULT_SPEED_KMH)
+    _etas_computed_at = time.monotonic()
+    return delivery_etas
+
+def _eta_loop():
+    while True:
+        socketio.sleep(ETA_TICK_SECONDS)
+        with app.app_context():
+            try:
+                previous = delivery_etas
+                etas = refresh_delivery_etas()
+                for order_id, eta in etas.items():
+                    if eta['eta_minutes'] is not None and eta != previous.get(order_id):
+                        socketio.emit(f'order_{order_id}_eta', eta, room=f'order_{order_id}')
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"ETA refresh error: {e}")
+
+def ensure_eta_ticker():
+    global _eta_ticker_started
+    if not _eta_ticker_started:
+        _eta_ticker_started = True
+        socketio.start_background_task(_eta_loop)
+
+def get_delivery_etas():
+    """Latest batch of ETAs, computing one now only if the ticker has fallen behind"""
+    ensure_eta_ticker()
+    if _etas_computed_at is None or time.monotonic() - _etas_computed_at > ETA_TICK_SECONDS * 2:
+        refresh_delivery_etas()
+    return delivery_etas
+
+def claim_order(order_id, rider_id, status=None, max_active=None):
+    """Give a pending order to a rider unless someone else already has it; returns True on success.
+    
+    The check and the write are a single conditional UPDATE, so concurrent
+    claims from riders, workers and dispatch batches cannot both succeed.
+    ``max_active`` also refuses riders already carrying that many orders.
+    """
+    conditions = [
+        Order.id == order_id,
+        Order.status == 'pending',
+        db.or_(Order.rider_id.is_(None), Order.rider_id == rider_id)
+    ]
+    if max_active is not None:
+        other = db.aliased(Order)
+        active = db.select(db.func.count(other.id)).where(
+            other.rider_id == rider_id,
+            other.status.in_(ACTIVE_ORDER_STATUSES),
+            other.id != order_id
+        ).scalar_subquery()
+        conditions.append(active < max_active)
+    values = {'rider_id': rider_id, 'offered_at': datetime.utcnow()}
+    if status:
+        values['status'] = status
+    return Order.query.filter(*conditions).update(values, synchronize_session=False) == 1
+
+def release_offers(online_rider_ids):
+    """Put unaccepted offers back in the pool when they time out or their rider goes offline.
+    
+    Returns the released ``(order_id, rider_id)`` pairs; the caller commits, then
+    tells the riders with ``notify_offers_withdrawn``.
+    """
+    # Orders assigned before offers were timestamped count from creation
+    offered = db.func.coalesce(Order.offered_at, Order.created_at)
+    stale = db.or_(
+        Order.rider_id.notin_(online_rider_ids) if online_rider_ids else db.true(),
+        offered < datetime.utcnow() - timedelta(seconds=DISPATCH_OFFER_TIMEOUT_SECONDS)
+    )
+    conditions = [Order.status == 'pending', Order.rider_id.isnot(None), stale]
+    rows = db.session.execute(db.select(Order.id, Order.rider_id).where(*conditions)).all()
+    if not rows:
+        return []
+    # Re-checking the conditions leaves alone any offer accepted since the select
+    db.session.execute(db.update(Order).where(
+        Order.id.in_([order_id for order_id, _ in rows]), *conditions
+    ).values(rider_id=None, offered_at=None).execution_options(synchronize_session=False))
+    return [(order_id, rider_id) for order_id, rider_id in rows]
+
+def notify_offers_withdrawn(released):
+    for order_id, rider_id in released:
+        socketio.emit('order_offer_withdrawn', {'order_id': order_id}, room=f'user_{rider_id}')
+
+def _take_dispatch_lock():
+    """Hold a transaction-scoped advisory lock on PostgreSQL; False if another worker has it"""
+    if db.engine.dialect.name != 'postgresql':
+        return True
+    return bool(db.session.execute(
+        db.text('SELECT pg_try_advisory_xact_lock(:key)'), {'key': DISPATCH_LOCK_KEY}
+    ).scalar())
+
+def assign_pending_orders():
+    """Match unassigned pending orders to free online riders, minimising total pickup distance"""
+    if not _take_dispatch_lock():
+        return []
+    online = get_presence().online_ids('rider')
+    released = release_offers(online)
+    index = get_rider_index()
+    load = dict(db.session.query(Order.rider_id, db.func.count(Order.id)).filter(
+        Order.rider_id.in_(online),
+        Order.status.in_(ACTIVE_ORDER_STATUSES)
+    ).group_by(Order.rider_id).all()) if online else {}
+    full = {rider_id for rider_id, count in load.items() if count >= RIDER_MAX_ACTIVE_ORDERS}
+    
+    seller = db.aliased(User)
+    rows = db.session.query(
+        Order.id, seller.latitude, seller.longitude, Order.delivery_lat, Order.delivery_lng
+    ).outerjoin(seller, Order.seller_id == seller.id).filter(
+        Order.rider_id.is_(None),
+        Order.status == 'pending'
+    ).order_by(Order.created_at, Order.id).limit(DISPATCH_MAX_ORDERS).all() if online else []
+    orders = []
+    for order_id, seller_lat, seller_lng, drop_lat, drop_lng in rows:
+        if seller_lat is not None and seller_lng is not None:
+            orders.append((order_id, (seller_lat, seller_lng)))
+        elif drop_lat is not None and drop_lng is not None:
+            # No pickup location on file, so use the drop-off as before
+            orders.append((order_id, (drop_lat, drop_lng)))
+    
+    # Only the few free riders nearest each pickup become columns, so the matrix stays small however many are online
+    candidates = set()
+    for _, (lat, lng) in orders:
+        candidates.update(rider_id for _, rider_id in index.nearest(
+            lat, lng, k=DISPATCH_CANDIDATES_PER_ORDER, max_km=DISPATCH_RADIUS_KM, exclude=full
+        ) if rider_id in online)
+    riders = [(rider_id, rider_position(rider_id, *index.position(rider_id))) for rider_id in sorted(candidates)]
+    if not riders or not orders:
+        # Nothing to match, but released offers must still reach the pool
+        db.session.commit()
+        notify_offers_withdrawn(released)
+        return []
+    
+    cost = distance_matrix([position for _, position in riders], [pickup for _, pickup in orders])
+    assigned = []
+    for r, o in assign(cost, DISPATCH_RADIUS_KM * ROAD_FACTOR):
+        rider_id, order_id = riders[r][0], orders[o][0]
+        if claim_order(order_id, rider_id, max_active=RIDER_MAX_ACTIVE_ORDERS):
+            assigned.append({'order_id': order_id, 'rider_id': rider_id, 'pickup_km': round(cost[r][o], 2)})
+    db.session.commit()
+    
+    notify_offers_withdrawn(released)
+    for assignment in assigned:
+        socketio.emit('order_assigned', assignment, room=f"user_{assignment['rider_id']}")
+    return assigned
+
+def _dispatch_loop():
+    while True:
+        socketio.sleep(DISPATCH_TICK_SECONDS)
+        with app.app_context():
+            try:
+                assigned = assign_pending_orders()
+                if assigned:
+                    logger.info(f"Dispatched {len(assigned)} orders")
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Dispatch error: {e}")
+
+def ensure_dispatcher():
+    global _dispatcher_started
+    if not _dispatcher_started:
+        _dispatcher_started = True
+        socketio.start_background_task(_dispatch_loop)
+
+def start_background_tasks():
+    """Start every periodic loop; called once per worker at startup so none waits for traffic"""
+    ensure_location_flusher()
+    ensure_presence_flusher()
+    ensure_eta_ticker()
+    ensure_dispatcher()
+
+@atexit.register
+def _clear_presence_on_exit():
+    # Users connected here are gone with the process; do not wait for the TTL
+    if _presence_worker_id is None:
+        return
+    try:
+        with app.app_context():
+            db.session.query(UserPresence).filter(
+                UserPresence.worker_id == presence_worker_id()
+            ).delete(synchronize_session=False)
+            db.session.commit()
+    except Exception as e:
+        logger.error(f"Presence cleanup error: {e}")
+
+@atexit.register
+def _flush_location_buffer_on_exit():
+    with app.app_context():
+        flush_location_buffer()
+
+def _as_date(value):
+    # func.date() comes back as a string on SQLite and a date on PostgreSQL
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+def insert_ignore(model, **values):
+    """INSERT a row unless one with the same key already exists, without aborting the transaction"""
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+        db.session.execute(insert(model).values(**values).on_conflict_do_nothing())
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(model(**values))
+    except IntegrityError:
+        pass
+
+def _ensure_seller_metrics_row(seller_id):
+    # rebuilt_at stays NULL until the first rebuild; deltas collected before then are overwritten by it
+    insert_ignore(SellerMetrics, seller_id=seller_id, total_sales=0, total_units=0,
+                  unread_messages=0, pending_inquiries=0, rebuilt_at=None)
+
+def rebuild_seller_metrics(seller_id):
+    """Materialize a seller's dashboard metrics from the source tables.
+    
+    The metrics row is written and locked before aggregating, so a sale recorded
+    meanwhile waits for the rebuild and is then applied on top of it, and two
+    concurrent rebuilds run one after the other.
+    """
+    _ensure_seller_metrics_row(seller_id)
+    metrics = SellerMetrics.query.filter_by(seller_id=seller_id).populate_existing().with_for_update().one()
+    
+    total_sales, total_units = db.session.query(
+        db.func.coalesce(db.func.sum(Sale.total_price), 0),
+        db.func.coalesce(db.func.sum(Sale.quantity), 0)
+    ).filter(Sale.seller_id == seller_id).one()
+    
+    daily = db.session.query(
+        db.func.date(Sale.sale_date),
+        db.func.sum(Sale.total_price),
+        db.func.sum(Sale.quantity),
+        db.func.count(Sale.id)
+    ).filter(Sale.seller_id == seller_id).group_by(db.func.date(Sale.sale_date)).all()
+    
+    per_product = db.session.query(
+        Sale.product_id,
+        db.func.sum(Sale.quantity),
+        db.func.sum(Sale.total_price)
+    ).filter(Sale.seller_id == seller_id).group_by(Sale.product_id).all()
+    
+    SellerDailySales.query.filter_by(seller_id=seller_id).delete()
+    ProductSalesTotal.query.filter_by(seller_id=seller_id).delete()
+    
+    metrics.total_sales = float(total_sales)
+    metrics.total_units = int(total_units)
+    metrics.unread_messages = Message.query.filter_by(receiver_id=seller_id, is_read=False).count()
+    metrics.pending_inquiries = ProductInquiry.query.filter_by(seller_id=seller_id, status='pending').count()
+    metrics.rebuilt_at = datetime.utcnow()
+    db.session.add_all([
+        SellerDailySales(seller_id=seller_id, day=_as_date(day), total_sales=total, total_units=units, sale_count=count)
+        for day, total, units, count in daily if day
+    ])
+    db.session.add_all([
+        ProductSalesTotal(product_id=product_id, seller_id=seller_id, quantity_sold=quantity, revenue=revenue)
+        for product_id, quantity, revenue in per_product
+    ])
+    db.session.commit()
+    return metrics
+
+def adjust_seller_metrics(seller_id, **deltas):
+    """Apply counter deltas to a seller's metrics row, creating it first if needed"""
+    values = {getattr(SellerMetrics, field): getattr(SellerMetrics, field) + delta for field, delta in deltas.items() if delta}
+    if not values:
+        return
+    _ensure_seller_metrics_row(seller_id)
+    SellerMetrics.query.filter_by(seller_id=seller_id).update(values, synchronize_session=False)
+
+def record_sales_metrics(rows):
+    """Fold newly written Sale rows into the materialized seller metrics"""
+    by_seller = {}
+    for row in rows:
+        seller = by_seller.setdefault(row['seller_id'], {'total': 0, 'units': 0, 'days': {}, 'products': {}})
+        seller['total'] += row['total_price']
+        seller['units'] += row['quantity']
+        day = seller['days'].setdefault(row['sale_date'].date(), [0, 0, 0])
+        day[0] += row['total_price']
+        day[1] += row['quantity']
+        day[2] += 1
+        product = seller['products'].setdefault(row['product_id'], [0, 0])
+        product[0] += row['quantity']
+        product[1] += row['total_price']
+    
+    for seller_id, seller in by_seller.items():
+        # The UPDATE row-locks the seller, so the rollup inserts below cannot race
+        # each other or a rebuild; a later first rebuild replaces them wholesale.
+        adjust_seller_metrics(seller_id, total_sales=seller['total'], total_units=seller['units'])
+        
+        for day, (total, units, count) in seller['days'].items():
+            updated = SellerDailySales.query.filter_by(seller_id=seller_id, day=day).update({
+                SellerDailySales.total_sales: SellerDailySales.total_sales + total,
+                SellerDailySales.total_units: SellerDailySales.total_units + units,
+                SellerDailySales.sale_count: SellerDailySales.sale_count + count
+            }, synchronize_session=False)
+            if not updated:
+                db.session.add(SellerDailySales(seller_id=seller_id, day=day, total_sales=total, total_units=units, sale_count=count))
+        
+        for product_id, (quantity, revenue) in seller['products'].items():
+            updated = ProductSalesTotal.query.filter_by(product_id=product_id).update({
+                ProductSalesTotal.quantity_sold: ProductSalesTotal.quantity_sold + quantity,
+                ProductSalesTotal.revenue: ProductSalesTotal.revenue + revenue
+            }, synchronize_session=False)
+            if not updated:
+                db.session.add(ProductSalesTotal(product_id=product_id, seller_id=seller_id, quantity_sold=quantity, revenue=revenue))
+
+def compute_admin_stats():
+    """Platform-wide counts and revenue totals for the admin dashboard"""
+    role_counts = dict(db.session.query(User.role, db.func.count(User.id)).group_by(User.role).all())
+    
+    totals = db.session.query(
+        db.func.count(Order.id),
+        db.func.coalesce(db.func.sum(db.case((Order.status == 'pending', 1), else_=0)), 0),
+        db.func.coalesce(db.func.sum(db.case((Order.status == 'completed', 1), else_=0)), 0),
+        db.func.coalesce(db.func.sum(Order.total), 0),
+        db.func.coalesce(db.func.sum(Order.platform_fee), 0),
+        db.func.coalesce(db.func.sum(Order.rider_fee), 0),
+        db.session.query(db.func.count(Product.id)).scalar_subquery(),
+        db.session.query(db.func.count(VideoCall.id)).filter(VideoCall.status == 'active').scalar_subquery()
+    ).one()
+    total_orders, pending_orders, completed_orders, total_revenue, total_platform_fees, total_rider_fees, total_products, active_calls = totals
+    
+    return {
+        'total_users': sum(role_counts.values()),
+        'total_sellers': role_counts.get('seller', 0),
+        'total_riders': role_counts.get('rider', 0),
+        'total_buyers': role_counts.get('buyer', 0),
+        'total_products': total_products,
+        'total_orders': total_orders,
+        'pending_orders': int(pending_orders),
+        'completed_orders': int(completed_orders),
+        'total_revenue': float(total_revenue),
+        'total_platform_fees': float(total_platform_fees),
+        'total_rider_fees': float(total_rider_fees),
+        'active_calls': active_calls
+    }
+
 def generate_receipt_number():
     return f"REC-{datetime.now().strftime('%Y%m%d')}-{uuid.uuid4().hex[:8].upper()}"
 
@@ -472,9 +1471,8 @@ def not_found_error(error):
 @app.context_processor
 def inject_available_riders():
     if 'user_id' in session:
-        available_riders = User.query.filter_by(role='rider', is_online=True).limit(5).all()
-        return dict(available_riders=available_riders)
-    return dict(available_riders=[])
+        return dict(available_riders=get_available_riders(), current_user=get_current_user())
+    return dict(available_riders=[], current_user=None)
 
 # ===== AUTHENTICATION ROUTES =====
 
@@ -563,6 +1561,9 @@ def login():
                 user.last_seen = datetime.utcnow()
                 db.session.commit()
                 
+                if user.role == 'rider':
+                    rider_index.update(user.id, user.latitude, user.longitude)
+                
                 # Get unread message count
                 try:
                     unread_count = Message.query.filter_by(receiver_id=user.id, is_read=False).count()
@@ -595,11 +1596,12 @@ def login():
 def logout():
     try:
         if 'user_id' in session:
-            user = User.query.get(session['user_id'])
+            user = get_current_user()
             if user:
                 user.is_online = False
                 user.last_seen = datetime.utcnow()
                 db.session.commit()
+                rider_index.remove(user.id)
     except:
         pass
     
@@ -612,8 +1614,10 @@ def logout():
 @app.route('/')
 def index():
     try:
-        products = Product.query.filter_by(is_active=True).order_by(Product.created_at.desc()).limit(8).all()
-        return render_template('index.html', products=products)
+        def render():
+            ids = cached_product_ids(('newest', 8), Product.query.filter_by(is_active=True).order_by(Product.created_at.desc()).limit(8))
+            return render_template('index.html', products=load_products(ids))
+        return cached_page(('index',), render)
     except Exception as e:
         logger.error(f"Index error: {e}")
         return render_template('index.html', products=[])
@@ -623,25 +1627,62 @@ def products():
     try:
         category = request.args.get('category')
         search = request.args.get('search')
-        seller_id = request.args.get('seller')
-        
-        query = Product.query.filter_by(is_active=True)
-        if category:
-            query = query.filter_by(category=category)
-        if search:
-            query = query.filter(Product.name.ilike(f'%{search}%'))
-        if seller_id:
-            query = query.filter_by(seller_id=seller_id)
-        
-        products = query.order_by(Product.created_at.desc()).all()
-        categories = db.session.query(Product.category).distinct().all()
-        category_list = [c[0] for c in categories if c[0]]
-        return render_template('products.html', products=products, categories=category_list)
+        seller_id = request.args.get('seller', type=int)
+        cursor = request.args.get('cursor')
+        limit = request.args.get('limit', PRODUCTS_PER_PAGE, type=int)
+        
+        def render():
+            products, next_cursor, total = list_products(category, search, seller_id, cursor, limit)
+            category_list = catalog_cache.get_or_set('categories', lambda: get_product_index().values('category'))
+            return render_template('products.html',
+                                 products=products,
+                                 categories=category_list,
+                                 next_cursor=next_cursor,
+                                 total=total)
+        
+        limit = max(1, min(limit, PRODUCTS_MAX_PAGE_SIZE))
+        try:
+            return cached_page(('products', category or None, search or None, seller_id, cursor or None, limit), render)
+        except ValueError:
+            # A malformed or tampered cursor falls back to the first page
+            cursor = None
+            return cached_page(('products', category or None, search or None, seller_id, None, limit), render)
     except Exception as e:
         logger.error(f"Products error: {e}")
         flash('Error loading products.', 'danger')
         return redirect(url_for('index'))
 
+@app.route('/api/products')
+def api_products():
+    try:
+        products, next_cursor, total = list_products(
+            request.args.get('category'),
+            request.args.get('search'),
+            request.args.get('seller', type=int),
+            request.args.get('cursor'),
+            request.args.get('limit', PRODUCTS_PER_PAGE, type=int)
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    except Exception as e:
+        logger.error(f"Products API error: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({
+        'products': [{
+            'id': p.id,
+            'name': p.name,
+            'price': p.price,
+            'category': p.category,
+            'image_url': p.image_url,
+            'stock': p.stock,
+            'seller_id': p.seller_id,
+            'created_at': p.created_at.isoformat() if p.created_at else None
+        } for p in products],
+        'next_cursor': next_cursor,
+        'total': total
+    })
+
 @app.route('/product/<int:id>')
 def product_detail(id):
     try:
@@ -680,6 +1721,7 @@ def product_inquiry(id):
     
     try:
         db.session.add(inquiry)
+        adjust_seller_metrics(product.seller_id, pending_inquiries=1)
         db.session.commit()
         flash('Your question has been sent to the seller!', 'success')
     except Exception as e:
@@ -744,11 +1786,14 @@ def answer_inquiry(id):
         flash('Answer cannot be empty.', 'danger')
         return redirect(url_for('seller_inquiries'))
     
+    was_pending = inquiry.status == 'pending'
     inquiry.answer = answer
     inquiry.status = 'answered'
     inquiry.answered_at = datetime.utcnow()
     
     try:
+        if was_pending:
+            adjust_seller_metrics(inquiry.seller_id, pending_inquiries=-1)
         db.session.commit()
         flash('Answer sent to buyer!', 'success')
     except Exception as e:
@@ -763,30 +1808,19 @@ def answer_inquiry(id):
 @role_required('seller')
 def seller_dashboard():
     try:
-        seller = User.query.get(session['user_id'])
+        seller = get_current_user()
         
-        # Get seller's products
-        products = Product.query.filter_by(seller_id=seller.id, is_active=True).all()
+        # Dashboard counters come from the materialized metrics, built on first view
+        metrics = SellerMetrics.query.get(seller.id)
+        if metrics is None or metrics.rebuilt_at is None:
+            metrics = rebuild_seller_metrics(seller.id)
         
-        # Get sales data
-        today = datetime.now().date()
+        today_rollup = SellerDailySales.query.filter_by(seller_id=seller.id, day=datetime.utcnow().date()).first()
+        today_sales = today_rollup.total_sales if today_rollup else 0
         
-        # Today's sales
-        try:
-            today_sales = db.session.query(db.func.coalesce(db.func.sum(Sale.total_price), 0)).filter(
-                Sale.seller_id == seller.id,
-                db.func.date(Sale.sale_date) == today
-            ).scalar() or 0
-        except:
-            today_sales = 0
-        
-        # Total sales
-        try:
-            total_sales = db.session.query(db.func.coalesce(db.func.sum(Sale.total_price), 0)).filter(
-                Sale.seller_id == seller.id
-            ).scalar() or 0
-        except:
-            total_sales = 0
+        # Seller's products
+        total_products = Product.query.filter_by(seller_id=seller.id, is_active=True).count()
+        products = Product.query.filter_by(seller_id=seller.id, is_active=True).order_by(Product.created_at.desc()).limit(20).all()
         
         # Recent orders
         try:
@@ -795,15 +1829,19 @@ def seller_dashboard():
             recent_orders = []
         
         # Low stock alerts
-        low_stock_products = [p for p in products if p.stock <= p.low_stock_threshold]
+        low_stock_products = Product.query.filter(
+            Product.seller_id == seller.id,
+            Product.is_active == True,
+            Product.stock <= Product.low_stock_threshold
+        ).all()
         
         # Top products
         try:
-            top_products = db.session.query(
-                Product, db.func.coalesce(db.func.sum(Sale.quantity), 0).label('total_sold')
-            ).outerjoin(Sale, Sale.product_id == Product.id).filter(
-                Product.seller_id == seller.id
-            ).group_by(Product.id).order_by(db.desc('total_sold')).limit(5).all()
+            top_products = db.session.query(Product, ProductSalesTotal.quantity_sold.label('total_sold')).join(
+                ProductSalesTotal, ProductSalesTotal.product_id == Product.id
+            ).filter(
+                ProductSalesTotal.seller_id == seller.id
+            ).order_by(ProductSalesTotal.quantity_sold.desc()).limit(5).all()
         except:
             top_products = []
         
@@ -813,19 +1851,13 @@ def seller_dashboard():
         except:
             recent_customers = []
         
-        # Unread messages
-        unread_messages = Message.query.filter_by(receiver_id=seller.id, is_read=False).count()
-        
-        # Pending inquiries
-        pending_inquiries = ProductInquiry.query.filter_by(seller_id=seller.id, status='pending').count()
-        
         stats = {
-            'total_products': len(products),
-            'total_sales': float(total_sales),
+            'total_products': total_products,
+            'total_sales': float(metrics.total_sales),
             'today_sales': float(today_sales),
             'low_stock_count': len(low_stock_products),
-            'unread_messages': unread_messages,
-            'pending_inquiries': pending_inquiries
+            'unread_messages': max(metrics.unread_messages, 0),
+            'pending_inquiries': max(metrics.pending_inquiries, 0)
         }
         
         return render_template('seller_dashboard.html', 
@@ -845,11 +1877,17 @@ def seller_dashboard():
 @role_required('seller')
 def seller_products():
     try:
-        seller = User.query.get(session['user_id'])
+        seller = get_current_user()
         show_all = request.args.get('show_all', 'false').lower() == 'true'
         
+        next_cursor = None
         if show_all:
-            products = Product.query.filter_by(is_active=True).all()
+            products, next_cursor, _ = list_products(
+                request.args.get('category'),
+                request.args.get('search'),
+                cursor=request.args.get('cursor'),
+                limit=request.args.get('limit', PRODUCTS_PER_PAGE, type=int)
+            )
             comparison_mode = True
         else:
             products = Product.query.filter_by(seller_id=seller.id, is_active=True).all()
@@ -858,6 +1896,7 @@ def seller_products():
         return render_template('seller_products.html', 
                              products=products, 
                              seller=seller,
+                             next_cursor=next_cursor,
                              comparison_mode=comparison_mode)
     except Exception as e:
         logger.error(f"Seller products error: {e}")
@@ -921,6 +1960,8 @@ def add_product():
             
             db.session.add(product)
             db.session.commit()
+            index_product(product)
+            invalidate_catalog()
             
             # Log inventory addition
             log_inventory_change(product.id, session['user_id'], 0, stock, 'initial_stock')
@@ -973,6 +2014,8 @@ def edit_product(id):
                 product.image_url = request.form['image_url']
             
             db.session.commit()
+            index_product(product)
+            invalidate_catalog()
             
             # Log inventory change if stock changed
             if product.stock != previous_stock:
@@ -1000,6 +2043,8 @@ def delete_product(id):
     try:
         product.is_active = False
         db.session.commit()
+        product_index.remove(product.id)
+        invalidate_catalog()
         flash('Product deleted successfully!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -1012,7 +2057,7 @@ def delete_product(id):
 @role_required('seller')
 def seller_inventory():
     try:
-        seller = User.query.get(session['user_id'])
+        seller = get_current_user()
         products = Product.query.filter_by(seller_id=seller.id, is_active=True).all()
         
         # Get inventory logs
@@ -1059,6 +2104,7 @@ def restock_product(id):
         previous_stock = product.stock
         product.stock += quantity
         db.session.commit()
+        invalidate_catalog()
         
         log_inventory_change(product.id, session['user_id'], previous_stock, product.stock, 'restock')
         
@@ -1075,7 +2121,7 @@ def restock_product(id):
 @role_required('seller')
 def pos_dashboard():
     try:
-        seller = User.query.get(session['user_id'])
+        seller = get_current_user()
         products = Product.query.filter_by(seller_id=seller.id, is_active=True).filter(Product.stock > 0).all()
         
         # Today's offline sales
@@ -1103,7 +2149,7 @@ def pos_dashboard():
 @role_required('seller')
 def pos_checkout():
     try:
-        seller = User.query.get(session['user_id'])
+        seller = get_current_user()
         
         data = request.get_json()
         cart = data.get('cart', [])
@@ -1116,49 +2162,76 @@ def pos_checkout():
         if not cart:
             return jsonify({'error': 'Cart is empty'}), 400
         
+        # Merge repeated lines so stock is checked against the combined quantity
+        quantities = {}
+        try:
+            for item in cart:
+                product_id = int(item['product_id'])
+                quantity = int(item['quantity'])
+                if quantity <= 0:
+                    return jsonify({'error': f'Invalid quantity for product: {product_id}'}), 400
+                quantities[product_id] = quantities.get(product_id, 0) + quantity
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': 'Invalid cart item'}), 400
+        
+        # Load and lock every cart product in a single query
+        products = Product.query.filter(Product.id.in_(quantities.keys())).with_for_update().all()
+        products_by_id = {product.id: product for product in products}
+        
+        for product_id, quantity in quantities.items():
+            product = products_by_id.get(product_id)
+            if not product or product.seller_id != seller.id:
+                db.session.rollback()
+                return jsonify({'error': f'Invalid product: {product_id}'}), 400
+            if product.stock < quantity:
+                db.session.rollback()
+                return jsonify({'error': f'Insufficient stock for {product.name}'}), 400
+        
         items = []
+        sale_rows = []
+        log_rows = []
         subtotal = 0
+        now = datetime.utcnow()
         
-        for item in cart:
-            product = Product.query.get(item['product_id'])
-            if not product or product.seller_id != seller.id:
-                return jsonify({'error': f'Invalid product: {item["product_id"]}'}), 400
-            
-            if product.stock < item['quantity']:
-                return jsonify({'error': f'Insufficient stock for {product.name}'}), 400
+        for product_id, quantity in quantities.items():
+            product = products_by_id[product_id]
             
             # Update stock
             previous_stock = product.stock
-            product.stock -= item['quantity']
+            product.stock -= quantity
             
-            item_total = product.price * item['quantity']
+            item_total = product.price * quantity
             subtotal += item_total
             
             items.append({
                 'product_id': product.id,
                 'product_name': product.name,
-                'quantity': item['quantity'],
+                'quantity': quantity,
                 'unit_price': product.price,
                 'total': item_total
             })
             
-            # Log inventory change
-            log_inventory_change(product.id, seller.id, previous_stock, product.stock, 'pos_sale')
+            sale_rows.append({
+                'seller_id': seller.id,
+                'product_id': product.id,
+                'quantity': quantity,
+                'unit_price': product.price,
+                'total_price': item_total,
+                'sale_type': 'pos',
+                'status': 'completed',
+                'payment_method': payment_method,
+                'sale_date': now
+            })
             
-            # Record sale
-            try:
-                sale = Sale(
-                    seller_id=seller.id,
-                    product_id=product.id,
-                    quantity=item['quantity'],
-                    unit_price=product.price,
-                    total_price=item_total,
-                    sale_type='pos',
-                    payment_method=payment_method
-                )
-                db.session.add(sale)
-            except:
-                pass
+            log_rows.append({
+                'product_id': product.id,
+                'seller_id': seller.id,
+                'previous_stock': previous_stock,
+                'new_stock': product.stock,
+                'change': -quantity,
+                'reason': 'pos_sale',
+                'created_at': now
+            })
         
         total = subtotal - discount
         
@@ -1175,6 +2248,14 @@ def pos_checkout():
             receipt_number=receipt_number
         )
         db.session.add(offline_sale)
+        db.session.flush()
+        
+        # Bulk insert sale and inventory rows inside the same transaction
+        for row in log_rows:
+            row['reference_id'] = offline_sale.id
+        db.session.execute(db.insert(Sale), sale_rows)
+        db.session.execute(db.insert(InventoryLog), log_rows)
+        record_sales_metrics(sale_rows)
         
         # Update or create customer
         if customer_name:
@@ -1235,7 +2316,7 @@ def pos_receipt(receipt_number):
 @role_required('seller')
 def customer_list():
     try:
-        seller = User.query.get(session['user_id'])
+        seller = get_current_user()
         customers = Customer.query.filter_by(seller_id=seller.id).order_by(Customer.total_purchases.desc()).all()
         return render_template('customer_list.html', customers=customers)
     except Exception as e:
@@ -1298,7 +2379,7 @@ def add_customer():
 @role_required('seller')
 def sales_report():
     try:
-        seller = User.query.get(session['user_id'])
+        seller = get_current_user()
         
         period = request.args.get('period', 'month')
         today = datetime.now().date()
@@ -1367,26 +2448,14 @@ def sales_report():
 @login_required
 def cart():
     try:
-        cart_items = session.get('cart', {})
-        products = []
-        subtotal = 0
-        
-        for product_id, quantity in cart_items.items():
-            product = Product.query.get(int(product_id))
-            if product and product.is_active:
-                products.append({'product': product, 'quantity': quantity})
-                subtotal += product.price * quantity
-        
-        rider_fee = subtotal * 0.10
-        platform_fee = subtotal * 0.10
-        total = subtotal + rider_fee + platform_fee
+        pricing = price_cart(session.get('cart', {}))
         
         return render_template('cart.html', 
-                             products=products, 
-                             subtotal=subtotal,
-                             rider_fee=rider_fee,
-                             platform_fee=platform_fee,
-                             total=total)
+                             products=pricing['items'], 
+                             subtotal=pricing['subtotal'],
+                             rider_fee=pricing['rider_fee'],
+                             platform_fee=pricing['platform_fee'],
+                             total=pricing['total'])
     except Exception as e:
         logger.error(f"Cart error: {e}")
         flash('Error loading cart.', 'danger')
@@ -1432,39 +2501,22 @@ def checkout():
             delivery_lng = request.form.get('delivery_lng', type=float)
             payment_method = request.form.get('payment_method', 'cash')
             notes = request.form.get('notes', '')
-            user = User.query.get(session['user_id'])
+            user = get_current_user()
             
-            subtotal = 0
-            order_items = []
-            sellers = set()
-            
-            for product_id, quantity in cart.items():
-                product = Product.query.get(int(product_id))
-                if product and product.is_active and product.stock >= quantity:
-                    item_total = product.price * quantity
-                    subtotal += item_total
-                    sellers.add(product.seller_id)
-                    order_items.append({
-                        'product': product,
-                        'quantity': quantity,
-                        'price': product.price,
-                        'seller_price': product.base_price
-                    })
+            pricing = price_cart(cart, require_stock=True, lock=True)
+            order_items = pricing['items']
+            sellers = pricing['sellers']
             
             if not order_items:
                 flash('Some items are no longer available.', 'warning')
                 return redirect(url_for('cart'))
             
-            rider_fee = subtotal * 0.10
-            platform_fee = subtotal * 0.10
-            total = subtotal + rider_fee + platform_fee
-            
             order = Order(
                 user_id=user.id,
-                subtotal=subtotal,
-                rider_fee=rider_fee,
-                platform_fee=platform_fee,
-                total=total,
+                subtotal=pricing['subtotal'],
+                rider_fee=pricing['rider_fee'],
+                platform_fee=pricing['platform_fee'],
+                total=pricing['total'],
                 status='pending',
                 delivery_address=delivery_address,
                 delivery_lat=delivery_lat,
@@ -1479,6 +2531,9 @@ def checkout():
             db.session.add(order)
             db.session.flush()
             
+            sale_rows = []
+            log_rows = []
+            now = datetime.utcnow()
             for item in order_items:
                 product = item['product']
                 
@@ -1495,7 +2550,16 @@ def checkout():
                 )
                 db.session.add(order_item)
                 
-                log_inventory_change(product.id, product.seller_id, previous_stock, product.stock, 'order', order.id)
+                log_rows.append({
+                    'product_id': product.id,
+                    'seller_id': product.seller_id,
+                    'previous_stock': previous_stock,
+                    'new_stock': product.stock,
+                    'change': product.stock - previous_stock,
+                    'reason': 'order',
+                    'reference_id': order.id,
+                    'created_at': now
+                })
                 
                 try:
                     sale = Sale(
@@ -1505,18 +2569,29 @@ def checkout():
                         unit_price=item['price'],
                         total_price=item['price'] * item['quantity'],
                         sale_type='online',
-                        status='pending'
+                        status='pending',
+                        sale_date=datetime.utcnow()
                     )
                     db.session.add(sale)
+                    sale_rows.append({
+                        'seller_id': sale.seller_id,
+                        'product_id': sale.product_id,
+                        'quantity': sale.quantity,
+                        'total_price': sale.total_price,
+                        'sale_date': sale.sale_date
+                    })
                 except:
                     pass
             
-            rider = find_nearest_rider(delivery_address)
-            if rider:
-                order.rider_id = rider.id
+            # Inventory rows go in with the order, so the single commit below releases the stock locks
+            db.session.execute(db.insert(InventoryLog), log_rows)
+            record_sales_metrics(sale_rows)
             
             db.session.commit()
             
+            # The dispatcher assigns a rider on its next batch
+            ensure_dispatcher()
+            
             # Clear cart
             session['cart'] = {}
             
@@ -1531,29 +2606,17 @@ def checkout():
     
     # GET request - show checkout form
     try:
-        cart = session.get('cart', {})
-        products = []
-        subtotal = 0
+        pricing = price_cart(session.get('cart', {}))
         
-        for product_id, quantity in cart.items():
-            product = Product.query.get(int(product_id))
-            if product and product.is_active:
-                products.append({'product': product, 'quantity': quantity})
-                subtotal += product.price * quantity
-        
-        if not products:
+        if not pricing['items']:
             return redirect(url_for('cart'))
         
-        rider_fee = subtotal * 0.10
-        platform_fee = subtotal * 0.10
-        total = subtotal + rider_fee + platform_fee
-        
         return render_template('checkout.html', 
-                             products=products,
-                             subtotal=subtotal,
-                             rider_fee=rider_fee,
-                             platform_fee=platform_fee,
-                             total=total)
+                             products=pricing['items'],
+                             subtotal=pricing['subtotal'],
+                             rider_fee=pricing['rider_fee'],
+                             platform_fee=pricing['platform_fee'],
+                             total=pricing['total'])
     except Exception as e:
         logger.error(f"Checkout form error: {e}")
         flash('Error loading checkout.', 'danger')
@@ -1564,7 +2627,7 @@ def checkout():
 def order_detail(id):
     try:
         order = Order.query.get_or_404(id)
-        user = User.query.get(session['user_id'])
+        user = get_current_user()
         
         # Check if user has permission to view this order
         if user.role != 'admin' and order.user_id != user.id and order.seller_id != user.id and order.rider_id != user.id:
@@ -1581,7 +2644,7 @@ def order_detail(id):
 @login_required
 def orders():
     try:
-        user = User.query.get(session['user_id'])
+        user = get_current_user()
         
         if not user:
             flash('User not found.', 'danger')
@@ -1607,14 +2670,14 @@ def orders():
 def track_order(order_id):
     try:
         order = Order.query.get_or_404(order_id)
-        user = User.query.get(session['user_id'])
+        user = get_current_user()
         
         # Check permission
-        if user.role != 'admin' and order.user_id != user.id and order.rider_id != user.id:
+        if not can_track_order(user, order):
             flash('Access denied.', 'danger')
             return redirect(url_for('index'))
         
-        return render_template('track_order.html', order=order)
+        return render_template('track_order.html', order=order, eta=get_delivery_etas().get(order_id))
     except Exception as e:
         logger.error(f"Track order error: {e}")
         flash('Error loading tracking.', 'danger')
@@ -1632,45 +2695,25 @@ def update_rider_location():
         accuracy = data.get('accuracy', 0)
         order_id = data.get('order_id')
         
-        rider = User.query.get(rider_id)
-        rider.latitude = lat
-        rider.longitude = lng
-        rider.last_seen = datetime.utcnow()
-        
-        # Save location history
-        try:
-            location = UserLocation(
-                user_id=rider_id,
-                latitude=lat,
-                longitude=lng,
-                accuracy=accuracy
-            )
-            db.session.add(location)
-        except:
-            pass
+        if lat is None or lng is None:
+            return jsonify({'error': 'lat and lng are required'}), 400
+        lat, lng = float(lat), float(lng)
+        order_id = int(order_id) if order_id else None
+        now = datetime.utcnow()
         
-        # If this is for a specific order, update order tracking
+        # Live position goes out immediately; history is written by the background flusher
+        rider_index.update(rider_id, lat, lng)
+        rider_speeds.observe(rider_id, lat, lng, now)
         if order_id:
-            try:
-                tracking = OrderTracking(
-                    order_id=order_id,
-                    rider_lat=lat,
-                    rider_lng=lng,
-                    status='in_transit',
-                    timestamp=datetime.utcnow()
-                )
-                db.session.add(tracking)
-                
-                # Emit real-time update via SocketIO
-                socketio.emit(f'order_{order_id}_location', {
-                    'lat': lat,
-                    'lng': lng,
-                    'timestamp': datetime.utcnow().isoformat()
-                }, room=f'order_{order_id}')
-            except:
-                pass
+            socketio.emit(f'order_{order_id}_location', {
+                'lat': lat,
+                'lng': lng,
+                'timestamp': now.isoformat()
+            }, room=f'order_{order_id}')
         
-        db.session.commit()
+        ensure_location_flusher()
+        if location_buffer.add(rider_id, lat, lng, accuracy, order_id, now):
+            flush_location_buffer()
         
         return jsonify({'success': True})
     except Exception as e:
@@ -1682,29 +2725,125 @@ def update_rider_location():
 def get_rider_location(rider_id):
     try:
         rider = User.query.get_or_404(rider_id)
+        lat, lng, last_seen = rider.latitude, rider.longitude, rider.last_seen
+        
+        # Prefer a ping that has not been flushed to the database yet
+        pending = location_buffer.latest(rider_id)
+        if pending:
+            lat, lng, last_seen = pending
+        
         return jsonify({
-            'lat': rider.latitude,
-            'lng': rider.longitude,
-            'last_seen': rider.last_seen.isoformat() if rider.last_seen else None,
-            'is_online': rider.is_online
+            'lat': lat,
+            'lng': lng,
+            'last_seen': last_seen.isoformat() if last_seen else None,
+            'is_online': get_presence().is_online(rider.id)
         })
     except Exception as e:
         logger.error(f"Get rider location error: {e}")
         return jsonify({'error': str(e)}), 500
 
+def decode_tracking_cursor(cursor):
+    # Cursors used to be "timestamp|id"; the id part alone is still a valid position
+    row_id = int(cursor.rsplit('|', 1)[-1])
+    if row_id < 0:
+        raise ValueError(cursor)
+    return row_id
+
+def fetch_tracking_page(order_id, since=None, limit=TRACKING_PAGE_SIZE):
+    """Return tracking rows after a cursor, oldest first, and whether more remain.
+    
+    Workers flush buffered pings on their own schedule, so a row can be written
+    after later-stamped ones; paging on the insert-ordered id alone means a
+    late row still lands in the client's next page instead of being skipped.
+    """
+    query = db.session.query(
+        OrderTracking.id, OrderTracking.rider_lat, OrderTracking.rider_lng,
+        OrderTracking.status, OrderTracking.message, OrderTracking.timestamp
+    ).filter(OrderTracking.order_id == order_id)
+    if since:
+        query = query.filter(OrderTracking.id > decode_tracking_cursor(since))
+    rows = query.order_by(OrderTracking.id).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    # Within a page the route is still drawn in time order
+    rows.sort(key=lambda row: (row.timestamp, row.id))
+    return rows, has_more
+
+def summarize_track(rows):
+    """Split tracking rows into points, seconds between consecutive points, and status events"""
+    points = []
+    offsets = []
+    events = []
+    start = previous = None
+    for row in rows:
+        if row.rider_lat is not None and row.rider_lng is not None:
+            # Seconds since the previous point keep the time column as small integers
+            offsets.append(round((row.timestamp - (previous or row.timestamp)).total_seconds()))
+            points.append((row.rider_lat, row.rider_lng))
+            start = start or row.timestamp
+            previous = row.timestamp
+        if row.message or row.status != 'in_transit':
+            events.append({
+                'status': row.status,
+                'message': row.message,
+                'timestamp': row.timestamp.isoformat(),
+                'point': len(points) - 1
+            })
+    return points, offsets, events, start
+
 @app.route('/api/order-tracking/<int:order_id>')
 @login_required
 def get_order_tracking(order_id):
+    """Route history as an encoded polyline; pass the returned cursor as ``since`` to get only new points"""
     try:
-        tracking = OrderTracking.query.filter_by(order_id=order_id).order_by(OrderTracking.timestamp).all()
-        
-        return jsonify([{
-            'lat': t.rider_lat,
-            'lng': t.rider_lng,
-            'status': t.status,
-            'message': t.message,
-            'timestamp': t.timestamp.isoformat()
-        } for t in tracking])
+        order = Order.query.get(order_id)
+        if not order:
+            return jsonify({'error': 'Order not found'}), 404
+        if not can_track_order(get_current_user(), order):
+            return jsonify({'error': 'Access denied'}), 403
+        
+        since = request.args.get('since')
+        limit = min(request.args.get('limit', TRACKING_PAGE_SIZE, type=int), TRACKING_PAGE_SIZE)
+        try:
+            rows, has_more = fetch_tracking_page(order_id, since, max(limit, 1))
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        
+        if not rows and not since:
+            # Finished orders are compacted into a single archive row by retention.py
+            archive = OrderTrackArchive.query.filter_by(order_id=order_id).first()
+            if archive:
+                offsets = json.loads(archive.offsets)
+                return jsonify({
+                    'order_id': order_id,
+                    'status': order.status,
+                    'polyline': archive.polyline,
+                    'precision': TRACKING_POLYLINE_PRECISION,
+                    'count': len(offsets),
+                    'start': archive.started_at.isoformat() if archive.started_at else None,
+                    'offsets': offsets,
+                    'events': json.loads(archive.events),
+                    'cursor': None,
+                    'has_more': False,
+                    'archived': True
+                })
+        
+        points, offsets, events, start = summarize_track(rows)
+        return jsonify({
+            'order_id': order_id,
+            'status': order.status,
+            'polyline': encode_polyline(points, TRACKING_POLYLINE_PRECISION),
+            'precision': TRACKING_POLYLINE_PRECISION,
+            'count': len(points),
+            'start': start.isoformat() if start else None,
+            'offsets': offsets,
+            'events': events,
+            'cursor': str(max(row.id for row in rows)) if rows else since,
+            'has_more': has_more,
+            'live_event': f'order_{order_id}_location',
+            'eta': get_delivery_etas().get(order_id),
+            'eta_event': f'order_{order_id}_eta'
+        })
     except Exception as e:
         logger.error(f"Order tracking error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1723,7 +2862,7 @@ def initiate_video_call():
         product = Product.query.get(product_id) if product_id else None
         
         # Check if receiver is online
-        if not receiver.is_online:
+        if not get_presence().is_online(receiver.id):
             return jsonify({'error': 'User is offline'}), 400
         
         # Create video call room
@@ -1878,7 +3017,7 @@ def send_video_call_message(call_id):
 @role_required('rider')
 def rider_dashboard():
     try:
-        rider = User.query.get(session['user_id'])
+        rider = get_current_user()
         deliveries = Order.query.filter_by(rider_id=rider.id).order_by(Order.created_at.desc()).all()
         
         # Statistics
@@ -1887,12 +3026,27 @@ def rider_dashboard():
         in_transit = sum(1 for o in deliveries if o.status == 'in_transit')
         total_earnings = sum(o.rider_fee for o in deliveries if o.status == 'completed') if deliveries else 0
         
-        # Get available orders for assignment
-        available_orders = Order.query.filter_by(rider_id=None, status='pending').all()
+        # Orders the dispatcher could not place yet; riders may still claim them
+        available_orders = Order.query.options(db.joinedload(Order.seller)).filter_by(rider_id=None, status='pending').all()
+        
+        # Active deliveries come from the last ETA batch; open orders get this rider's pickup distance
+        etas = get_delivery_etas()
+        delivery_etas_by_order = {o.id: etas[o.id] for o in deliveries if o.id in etas}
+        pickup_km = {}
+        position = rider_position(rider.id, rider.latitude, rider.longitude)
+        pickups = [o for o in available_orders if o.seller and o.seller.latitude is not None and o.seller.longitude is not None]
+        if position and pickups:
+            distances = haversine_many(
+                [position[0]] * len(pickups), [position[1]] * len(pickups),
+                [o.seller.latitude for o in pickups], [o.seller.longitude for o in pickups]
+            )
+            pickup_km = {o.id: round(km * ROAD_FACTOR, 2) for o, km in zip(pickups, distances)}
         
         return render_template('rider_dashboard.html', 
                              deliveries=deliveries,
                              available_orders=available_orders,
+                             etas=delivery_etas_by_order,
+                             pickup_km=pickup_km,
                              stats={'completed': completed, 'pending': pending, 'in_transit': in_transit, 'earnings': total_earnings})
     except Exception as e:
         logger.error(f"Rider dashboard error: {e}")
@@ -1930,12 +3084,11 @@ def accept_order(id):
     try:
         order = Order.query.get_or_404(id)
         
-        if order.rider_id is not None:
+        # Open orders, or ones the dispatcher offered to this rider
+        if not claim_order(order.id, session['user_id'], status='in_transit'):
+            db.session.rollback()
             flash('Order already assigned to another rider.', 'danger')
             return redirect(url_for('rider_dashboard'))
-        
-        order.rider_id = session['user_id']
-        order.status = 'in_transit'
         db.session.commit()
         
         flash('Order accepted!', 'success')
@@ -1956,19 +3109,12 @@ def chat_with_user(receiver_id):
         product_id = request.args.get('product_id')
         product = Product.query.get(product_id) if product_id else None
         
-        # Get conversation history
-        messages = Message.query.filter(
-            ((Message.sender_id == session['user_id']) & (Message.receiver_id == receiver_id)) |
-            ((Message.sender_id == receiver_id) & (Message.receiver_id == session['user_id']))
-        ).order_by(Message.created_at).all()
+        # Newest page of conversation history; older pages come from the history API
+        page, next_cursor = fetch_message_page(session['user_id'], receiver_id)
+        messages = list(reversed(page))
         
-        # Mark messages as read
-        unread = Message.query.filter_by(receiver_id=session['user_id'], sender_id=receiver_id, is_read=False).all()
-        for msg in unread:
-            msg.is_read = True
-        
-        # Update session unread count
-        if unread:
+        # Mark messages as read and update session unread count
+        if mark_messages_read(session['user_id'], receiver_id):
             db.session.commit()
             total_unread = Message.query.filter_by(receiver_id=session['user_id'], is_read=False).count()
             session['unread_count'] = total_unread
@@ -1976,12 +3122,46 @@ def chat_with_user(receiver_id):
         return render_template('chat.html', 
                              receiver=receiver, 
                              messages=messages,
+                             next_cursor=next_cursor,
                              product=product)
     except Exception as e:
         logger.error(f"Chat error: {e}")
         flash('Error loading chat.', 'danger')
         return redirect(url_for('inbox'))
 
+@app.route('/api/chat/<int:receiver_id>/messages')
+@login_required
+def chat_history(receiver_id):
+    try:
+        limit = min(request.args.get('limit', CHAT_PAGE_SIZE, type=int), CHAT_MAX_PAGE_SIZE)
+        if limit <= 0:
+            return jsonify({'error': 'Invalid limit'}), 400
+        
+        try:
+            page, next_cursor = fetch_message_page(session['user_id'], receiver_id, request.args.get('before'), limit)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        
+        if not request.args.get('before') and mark_messages_read(session['user_id'], receiver_id):
+            db.session.commit()
+        
+        return jsonify({
+            'messages': [{
+                'id': m.id,
+                'sender_id': m.sender_id,
+                'receiver_id': m.receiver_id,
+                'product_id': m.product_id,
+                'message': m.message,
+                'is_read': m.is_read,
+                'created_at': m.created_at.isoformat()
+            } for m in page],
+            'next_cursor': next_cursor
+        })
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Chat history error: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/send_message', methods=['POST'])
 @login_required
 def send_message():
@@ -2002,6 +3182,8 @@ def send_message():
         )
         
         db.session.add(msg)
+        db.session.flush()
+        record_conversation_message(msg)
         db.session.commit()
         
         return redirect(url_for('chat_with_user', receiver_id=receiver_id, product_id=product_id))
@@ -2017,35 +3199,29 @@ def inbox():
     try:
         user_id = session['user_id']
         
-        # Get all unique conversations
-        sent = db.session.query(Message.receiver_id).filter(Message.sender_id == user_id).distinct().subquery()
-        received = db.session.query(Message.sender_id).filter(Message.receiver_id == user_id).distinct().subquery()
-        
-        conversation_partner_ids = db.session.query(sent.c.receiver_id).union(db.session.query(received.c.sender_id)).distinct().all()
-        conversation_partner_ids = [id[0] for id in conversation_partner_ids]
+        rows = Conversation.query.options(
+            db.joinedload(Conversation.user_a),
+            db.joinedload(Conversation.user_b),
+            db.joinedload(Conversation.last_message)
+        ).filter(
+            (Conversation.user_a_id == user_id) | (Conversation.user_b_id == user_id)
+        ).order_by(Conversation.last_message_at.desc()).all()
         
         conversations = []
-        for partner_id in conversation_partner_ids:
-            partner = User.query.get(partner_id)
+        for conversation in rows:
+            if conversation.user_a_id == user_id:
+                partner, unread_count = conversation.user_b, conversation.unread_a
+            else:
+                partner, unread_count = conversation.user_a, conversation.unread_b
             if not partner:
                 continue
-                
-            last_message = Message.query.filter(
-                ((Message.sender_id == user_id) & (Message.receiver_id == partner_id)) |
-                ((Message.sender_id == partner_id) & (Message.receiver_id == user_id))
-            ).order_by(Message.created_at.desc()).first()
-            
-            unread_count = Message.query.filter_by(sender_id=partner_id, receiver_id=user_id, is_read=False).count()
             
             conversations.append({
                 'partner': partner,
-                'last_message': last_message,
+                'last_message': conversation.last_message,
                 'unread_count': unread_count
             })
         
-        # Sort by last message time
-        conversations.sort(key=lambda x: x['last_message'].created_at if x['last_message'] else datetime.min, reverse=True)
-        
         return render_template('inbox.html', conversations=conversations)
     except Exception as e:
         logger.error(f"Inbox error: {e}")
@@ -2225,75 +3401,134 @@ def review_user(user_id):
 
 # ===== AI CHAT ASSISTANT =====
 
+def get_marketplace_stats():
+    """Active product and seller counts, refreshed every few minutes"""
+    return marketplace_stats_cache.get_or_set('stats', lambda: (
+        Product.query.filter_by(is_active=True).count(),
+        User.query.filter_by(role='seller').count()
+    ))
+
+def normalize_prompt(message):
+    return ' '.join(re.findall(r"[a-z0-9']+", message.lower()))
+
+_CACHEABLE_PROMPTS = {normalize_prompt(p) for p in AI_SUGGESTIONS}
+
+def ai_cache_key(user, message):
+    """Cache key for a generic question, or None if the answer should be personal"""
+    normalized = normalize_prompt(message)
+    if normalized not in _CACHEABLE_PROMPTS:
+        return None
+    product_count, seller_count = get_marketplace_stats()
+    return (normalized, user.role, product_count // 50, seller_count // 10)
+
+def build_ai_preamble(user, personal=True):
+    """Describe the user and marketplace to the model"""
+    if personal:
+        context = f"The user is a {user.role} named {user.username}. "
+        
+        # Get user's recent orders for context
+        recent_orders = Order.query.filter_by(user_id=user.id).order_by(Order.created_at.desc()).limit(3).all()
+        if recent_orders:
+            order_list = []
+            for order in recent_orders:
+                items = [f"{item.quantity}x {item.product.name}" for item in order.items]
+                order_list.append(f"Order #{order.id}: {', '.join(items)}")
+            context += f"They recently ordered: {'; '.join(order_list)}. "
+    else:
+        # Cached answers are shared, so they must not mention a particular user
+        context = f"The user is a {user.role}. "
+    
+    # Get marketplace stats
+    product_count, seller_count = get_marketplace_stats()
+    context += f"The marketplace has {product_count} products from {seller_count} sellers. "
+    
+    return f"You are a helpful assistant for Fresh Marketplace, a food delivery platform. {context}"
+
+def run_ai_job(job, message, preamble, cache_key=None):
+    """Stream a Cohere reply to the user's SocketIO room as it is generated"""
+    room = f'user_{job.user_id}'
+    try:
+        for event in get_ai_client().chat_stream(message=message, model="command", preamble=preamble, temperature=0.7):
+            job.check_deadline()
+            if getattr(event, 'event_type', None) == 'text-generation' and event.text:
+                job.append(event.text)
+                socketio.emit('ai_token', {'job_id': job.id, 'text': event.text}, room=room)
+        if cache_key and job.text:
+            ai_response_cache.set(cache_key, job.text)
+        socketio.emit('ai_done', {'job_id': job.id, 'text': job.text}, room=room)
+    except AIJobTimeout:
+        socketio.emit('ai_error', {'job_id': job.id, 'error': 'AI response timed out. Please try again.'}, room=room)
+        raise
+    except Exception as e:
+        logger.error(f"AI Error: {str(e)}")
+        socketio.emit('ai_error', {'job_id': job.id, 'error': 'AI service temporarily unavailable. Please try again later.'}, room=room)
+        raise
+
 @app.route('/ai-assistant', methods=['GET', 'POST'])
 @login_required
 def ai_assistant():
     response_text = None
     user_message = ""
     suggestions = []
+    job_id = None
+    pool_full = False
+    user_limited = False
     
     if request.method == 'POST':
-        user_message = request.form['message']
+        if request.is_json:
+            user_message = (request.get_json(silent=True) or {}).get('message', '')
+        else:
+            user_message = request.form['message']
         
-        if co:
+        if cohere_api_key:
             try:
-                # Get context about the user
-                user = User.query.get(session['user_id'])
-                
-                # Get user's recent orders for context
-                recent_orders = Order.query.filter_by(user_id=user.id).order_by(Order.created_at.desc()).limit(3).all()
-                
-                # Build context for AI
-                context = f"The user is a {user.role} named {user.username}. "
-                if recent_orders:
-                    order_list = []
-                    for order in recent_orders:
-                        items = [f"{item.quantity}x {item.product.name}" for item in order.items]
-                        order_list.append(f"Order #{order.id}: {', '.join(items)}")
-                    context += f"They recently ordered: {'; '.join(order_list)}. "
-                
-                # Get marketplace stats
-                product_count = Product.query.filter_by(is_active=True).count()
-                seller_count = User.query.filter_by(role='seller').count()
-                context += f"The marketplace has {product_count} products from {seller_count} sellers. "
-                
-                response = co.chat(
-                    message=user_message,
-                    model="command",
-                    preamble=f"You are a helpful assistant for Fresh Marketplace, a food delivery platform. {context}",
-                    temperature=0.7
-                )
+                user = get_current_user()
+                cache_key = ai_cache_key(user, user_message)
+                response_text = ai_response_cache.get(cache_key) if cache_key else None
                 
-                if hasattr(response, 'text'):
-                    response_text = response.text
-                elif isinstance(response, dict) and 'text' in response:
-                    response_text = response['text']
-                else:
-                    response_text = str(response)
-                    
-            except ImportError:
-                response_text = "Cohere library not properly configured."
+                if response_text is None:
+                    preamble = build_ai_preamble(user, personal=cache_key is None)
+                    job_id = ai_jobs.submit(user.id, run_ai_job, user_message, preamble, cache_key).id
+                elif request.is_json:
+                    return jsonify({'status': 'done', 'text': response_text, 'cached': True})
+            except AIUserLimitReached:
+                user_limited = True
+                response_text = "You already have a question being answered. Please wait for it to finish."
+            except AIQueueFull:
+                pool_full = True
+                response_text = "The assistant is busy answering other questions. Please try again in a moment."
             except Exception as e:
                 response_text = f"AI service temporarily unavailable. Please try again later."
                 logger.error(f"AI Error: {str(e)}")
         else:
             response_text = "AI assistant is currently unavailable. Please contact support if this persists."
+        
+        if request.is_json:
+            if job_id:
+                return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+            if pool_full:
+                return jsonify({'error': response_text}), 503, {'Retry-After': str(AI_RETRY_AFTER_SECONDS)}
+            if user_limited:
+                return jsonify({'error': response_text}), 429
+            return jsonify({'error': response_text}), 503
     
     # Generate contextual suggestions
-    suggestions = [
-        "What are today's specials?",
-        "How do I track my order?",
-        "What payment methods do you accept?",
-        "How do I become a seller?",
-        "Tell me about your delivery policy",
-        "Do you have any discounts?"
-    ]
+    suggestions = AI_SUGGESTIONS
     
     return render_template('ai_assistant.html', 
                          response=response_text, 
                          user_message=user_message,
+                         job_id=job_id,
                          suggestions=suggestions)
 
+@app.route('/api/ai-jobs/<job_id>')
+@login_required
+def ai_job_status(job_id):
+    job = ai_jobs.get(job_id)
+    if not job or job.user_id != session['user_id']:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
 # ===== NOTIFICATION API =====
 
 @app.route('/api/notifications')
@@ -2324,73 +3559,63 @@ def get_notifications():
 @role_required('admin')
 def admin_dashboard():
     try:
-        users = User.query.all()
-        products = Product.query.all()
-        orders = Order.query.order_by(Order.created_at.desc()).limit(50).all()
+        stats = admin_stats_cache.get_or_set('stats', compute_admin_stats)
         
-        # Statistics
-        total_users = len(users)
-        total_sellers = len([u for u in users if u.role == 'seller'])
-        total_riders = len([u for u in users if u.role == 'rider'])
-        total_buyers = len([u for u in users if u.role == 'buyer'])
-        
-        total_products = len(products)
-        total_orders = Order.query.count()
-        pending_orders = Order.query.filter_by(status='pending').count()
-        completed_orders = Order.query.filter_by(status='completed').count()
-        
-        # Revenue stats
-        total_revenue = db.session.query(db.func.coalesce(db.func.sum(Order.total), 0)).scalar() or 0
-        total_platform_fees = db.session.query(db.func.coalesce(db.func.sum(Order.platform_fee), 0)).scalar() or 0
-        total_rider_fees = db.session.query(db.func.coalesce(db.func.sum(Order.rider_fee), 0)).scalar() or 0
-        
-        # Active calls
-        try:
-            active_calls = VideoCall.query.filter_by(status='active').count()
-        except:
-            active_calls = 0
-        
-        stats = {
-            'total_users': total_users,
-            'total_sellers': total_sellers,
-            'total_riders': total_riders,
-            'total_buyers': total_buyers,
-            'total_products': total_products,
-            'total_orders': total_orders,
-            'pending_orders': pending_orders,
-            'completed_orders': completed_orders,
-            'total_revenue': float(total_revenue),
-            'total_platform_fees': float(total_platform_fees),
-            'total_rider_fees': float(total_rider_fees),
-            'active_calls': active_calls
-        }
+        users = User.query.limit(10).all()
+        products = Product.query.limit(10).all()
+        orders = Order.query.order_by(Order.created_at.desc()).limit(50).all()
         
         return render_template('admin_dashboard.html', 
                              stats=stats, 
-                             users=users[:10], 
-                             products=products[:10], 
+                             users=users, 
+                             products=products, 
                              orders=orders)
     except Exception as e:
         logger.error(f"Admin dashboard error: {e}")
         flash('Error loading dashboard.', 'danger')
         return redirect(url_for('index'))
 
+@app.route('/admin/ai-cache', methods=['GET', 'POST'])
+@role_required('admin')
+def admin_ai_cache():
+    if request.method == 'POST':
+        prompt = request.form.get('prompt') or (request.get_json(silent=True) or {}).get('prompt')
+        if prompt:
+            normalized = normalize_prompt(prompt)
+            for key in [k for k in ai_response_cache.keys() if k[0] == normalized]:
+                ai_response_cache.invalidate(key)
+        else:
+            ai_response_cache.clear()
+        marketplace_stats_cache.clear()
+    
+    return jsonify(ai_response_cache.stats())
+
+@app.route('/admin/dispatch', methods=['POST'])
+@role_required('admin')
+def admin_dispatch():
+    """Run a dispatch batch now instead of waiting for the next tick"""
+    try:
+        return jsonify({'assigned': assign_pending_orders()})
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Admin dispatch error: {e}")
+        return jsonify({'error': 'Dispatch failed'}), 500
+
 # ===== SOCKETIO EVENTS =====
 
 @socketio.on('connect')
 def handle_connect():
+    global _rider_index_synced_at
     if 'user_id' in session:
         user_id = session['user_id']
         join_room(f'user_{user_id}')
         
-        try:
-            user = User.query.get(user_id)
-            if user:
-                user.is_online = True
-                user.last_seen = datetime.utcnow()
-                db.session.commit()
-        except:
-            pass
+        ensure_presence_flusher()
+        ensure_dispatcher()
+        came_online = presence.connect(user_id, request.sid, session.get('role'))
+        if came_online and session.get('role') == 'rider' and rider_index.position(user_id) is None:
+            # Pick up the rider's stored position on the next dispatch
+            _rider_index_synced_at = None
 
 @socketio.on('disconnect')
 def handle_disconnect():
@@ -2398,14 +3623,13 @@ def handle_disconnect():
         user_id = session['user_id']
         leave_room(f'user_{user_id}')
         
-        try:
-            user = User.query.get(user_id)
-            if user:
-                user.is_online = False
-                user.last_seen = datetime.utcnow()
-                db.session.commit()
-        except:
-            pass
+        if presence.disconnect(user_id, request.sid):
+            rider_index.remove(user_id)
+
+@socketio.on('heartbeat')
+def handle_heartbeat(data=None):
+    if 'user_id' in session:
+        presence.heartbeat(session['user_id'], request.sid)
 
 @socketio.on('join_call')
 def handle_join_call(data):
@@ -2431,18 +3655,24 @@ def handle_leave_call(data):
 
 @socketio.on('track_order')
 def handle_track_order(data):
-    order_id = data.get('order_id')
+    order_id = (data or {}).get('order_id')
     if order_id and 'user_id' in session:
-        room = f'order_{order_id}'
-        join_room(room)
+        try:
+            order = Order.query.get(int(order_id))
+            if not order or not can_track_order(get_current_user(), order):
+                emit('track_order_denied', {'order_id': order_id})
+                return
+            join_room(f'order_{order.id}')
+        except (TypeError, ValueError):
+            emit('track_order_denied', {'order_id': order_id})
+        except Exception as e:
+            logger.error(f"Track order subscribe error: {e}")
 
 # ===== DATABASE INITIALIZATION =====
 
 def init_db():
+    """Seed demo accounts and sample products; run once per deploy by migrations.py"""
     with app.app_context():
-        # Create tables
-        db.create_all()
-        
         # Create admin if not exists
         if not User.query.filter_by(username='admin').first():
             admin = User(
@@ -2595,16 +3825,17 @@ def init_db():
                 db.session.commit()
                 logger.info(f"✅ Created {len(products)} sample products")
 
-# Initialize database on startup
-with app.app_context():
-    try:
-        db.create_all()
-        init_db()
-        logger.info("✅ Database initialization complete!")
-        logger.info("✅ Demo users: admin/admin123, seller1/seller123, rider1/rider123, buyer1/buyer123, benedict431/28734495")
-    except Exception as e:
-        logger.error(f"❌ Database initialization error: {e}")
-
 if __name__ == '__main__':
+    # Local development only; deployed workers rely on `python migrations.py upgrade --seed`
+    with app.app_context():
+        try:
+            db.create_all()
+            init_db()
+            logger.info("✅ Database initialization complete!")
+            logger.info("✅ Demo users: admin/admin123, seller1/seller123, rider1/rider123, buyer1/buyer123, benedict431/28734495")
+        except Exception as e:
+            logger.error(f"❌ Database initialization error: {e}")
+    
+    start_background_tasks()
     port = int(os.environ.get('PORT', 5000))
     socketio.run(app, host='0.0.0.0', port=port, debug=False, allow_unsafe_werkzeug=True)
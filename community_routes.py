@@ -2,11 +2,19 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_required, current_user
 from extensions import db  # IMPORT shared db instance
 from models import User, CommunityPost, CommunityReply, PostLike, ReplyMention, Notification
-from datetime import datetime
+from search_index import InvertedIndex
+from datetime import datetime, timedelta
 import re
+import time
 
 community_bp = Blueprint('community', __name__, url_prefix='/community')
 
+SEARCH_PER_PAGE = 20
+SEARCH_INDEX_REFRESH_SECONDS = 30
+post_index = InvertedIndex({'title': 3.0, 'content': 1.0, 'replies': 0.5})
+_post_index_synced_at = None
+_post_index_checked_at = None
+
 def create_notification(user_id, title, message, notification_type='community', link=None):
     """Helper function to create notifications"""
     notification = Notification(
@@ -19,6 +27,62 @@ def create_notification(user_id, title, message, notification_type='community',
     db.session.add(notification)
     return notification
 
+def index_post(post, reply_texts=None):
+    """Add or refresh a post, including its replies, in the search index"""
+    if reply_texts is None:
+        reply_texts = [r.content for r in CommunityReply.query.with_entities(CommunityReply.content).filter_by(post_id=post.id)]
+    post_index.add(
+        post.id,
+        {'title': post.title, 'content': post.content, 'replies': ' '.join(reply_texts)},
+        category=post.category,
+        sort_key=post.created_at.timestamp() if post.created_at else 0
+    )
+
+def unindex_post(post_id):
+    """Drop a deleted post from the search index"""
+    post_index.remove(post_id)
+
+def get_post_index():
+    """Return the post search index, picking up posts and replies written since the last sync"""
+    global _post_index_synced_at, _post_index_checked_at
+    now = time.monotonic()
+    if _post_index_checked_at is not None and now - _post_index_checked_at < SEARCH_INDEX_REFRESH_SECONDS:
+        return post_index
+    
+    synced_at = datetime.utcnow()
+    last_sync = _post_index_synced_at
+    if last_sync is None:
+        posts = CommunityPost.query.all()
+        replies = CommunityReply.query.with_entities(CommunityReply.post_id, CommunityReply.content).all()
+    else:
+        # A little overlap covers clock skew between workers
+        since = last_sync - timedelta(seconds=5)
+        changed_ids = {post_id for (post_id,) in CommunityReply.query.with_entities(CommunityReply.post_id).filter(
+            (CommunityReply.created_at >= since) | (CommunityReply.updated_at >= since)
+        )}
+        posts = CommunityPost.query.filter(
+            (CommunityPost.created_at >= since) | (CommunityPost.id.in_(changed_ids))
+        ).all()
+        replies = CommunityReply.query.with_entities(CommunityReply.post_id, CommunityReply.content).filter(
+            CommunityReply.post_id.in_([post.id for post in posts])
+        ).all() if posts else []
+    
+    reply_texts = {}
+    for post_id, content in replies:
+        reply_texts.setdefault(post_id, []).append(content)
+    for post in posts:
+        index_post(post, reply_texts.get(post.id, []))
+    
+    if last_sync is not None:
+        # Deletes leave no timestamp behind, so drop whatever no longer exists (e.g. removed on another worker)
+        existing = {post_id for (post_id,) in CommunityPost.query.with_entities(CommunityPost.id)}
+        for post_id in post_index.ids() - existing:
+            unindex_post(post_id)
+    
+    _post_index_synced_at = synced_at
+    _post_index_checked_at = now
+    return post_index
+
 def extract_mentions(text):
     """Extract @mentions from text"""
     mention_pattern = r'@(\w+)'
@@ -82,6 +146,7 @@ def create_post():
         
         db.session.add(post)
         db.session.commit()
+        index_post(post, [])
         
         flash('Post created successfully!', 'success')
         return redirect(url_for('community.view_post', post_id=post.id))
@@ -133,6 +198,7 @@ def reply_post(post_id):
             )
     
     db.session.commit()
+    index_post(post)
     flash('Reply posted successfully!', 'success')
     return redirect(url_for('community.view_post', post_id=post_id))
 
@@ -208,16 +274,28 @@ def my_posts():
 @community_bp.route('/search')
 def search():
     query = request.args.get('q', '')
+    category = request.args.get('category', 'all')
+    page = max(request.args.get('page', 1, type=int), 1)
     
+    posts = []
+    total = 0
     if query:
-        posts = CommunityPost.query.filter(
-            (CommunityPost.title.ilike(f'%{query}%')) |
-            (CommunityPost.content.ilike(f'%{query}%'))
-        ).order_by(CommunityPost.created_at.desc()).all()
-    else:
-        posts = []
+        def matches(meta):
+            return category == 'all' or meta['category'] == category
+        
+        total, ids = get_post_index().search(query, limit=SEARCH_PER_PAGE, offset=(page - 1) * SEARCH_PER_PAGE, where=matches)
+        if ids:
+            found = {post.id: post for post in CommunityPost.query.filter(CommunityPost.id.in_(ids)).all()}
+            posts = [found[i] for i in ids if i in found]
     
-    return render_template('community/search.html', posts=posts, query=query)
+    return render_template('community/search.html',
+                         posts=posts,
+                         query=query,
+                         selected_category=category,
+                         page=page,
+                         per_page=SEARCH_PER_PAGE,
+                         total=total,
+                         has_next=page * SEARCH_PER_PAGE < total)
 
 @community_bp.route('/notifications')
 @login_required
@@ -0,0 +1,88 @@
+"""Matching riders to orders over a distance matrix."""
+
+# Above this many matrix cells the O(n^2 m) Hungarian solve is too slow for a tick
+HUNGARIAN_MAX_CELLS = 10000
+
+
+def hungarian(cost):
+    """Minimum-cost assignment for a rectangular matrix; returns ``[(row, col), ...]``.
+
+    Every row is matched when there are at least as many columns as rows,
+    otherwise every column is.
+    """
+    if not cost or not cost[0]:
+        return []
+    transposed = len(cost) > len(cost[0])
+    if transposed:
+        cost = [list(column) for column in zip(*cost)]
+    n, m = len(cost), len(cost[0])
+    inf = float('inf')
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    match = [0] * (m + 1)
+    way = [0] * (m + 1)
+    for i in range(1, n + 1):
+        match[0] = i
+        j0 = 0
+        minv = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = match[j0]
+            row = cost[i0 - 1]
+            delta, j1 = inf, 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    reduced = row[j - 1] - u[i0] - v[j]
+                    if reduced < minv[j]:
+                        minv[j] = reduced
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta, j1 = minv[j], j
+            for j in range(m + 1):
+                if used[j]:
+                    u[match[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if match[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+    pairs = [(match[j] - 1, j - 1) for j in range(1, m + 1) if match[j]]
+    return [(col, row) for row, col in pairs] if transposed else pairs
+
+
+def greedy(cost, max_cost=None):
+    """Repeatedly take the cheapest remaining pair; fast, usually close to optimal"""
+    candidates = sorted(
+        (c, i, j) for i, row in enumerate(cost) for j, c in enumerate(row)
+        if max_cost is None or c <= max_cost
+    )
+    rows, cols, pairs = set(), set(), []
+    for _, i, j in candidates:
+        if i not in rows and j not in cols:
+            rows.add(i)
+            cols.add(j)
+            pairs.append((i, j))
+    return pairs
+
+
+def assign(cost, max_cost=None):
+    """Pairs minimising total cost, leaving out any pair costlier than ``max_cost``.
+
+    Small problems are solved exactly; larger ones fall back to greedy.
+    """
+    if not cost or not cost[0]:
+        return []
+    if len(cost) * len(cost[0]) > HUNGARIAN_MAX_CELLS:
+        return greedy(cost, max_cost)
+    if max_cost is None:
+        return hungarian(cost)
+    # Out-of-range pairs cost more than any feasible matching, so they are only used when unavoidable
+    penalty = max_cost * min(len(cost), len(cost[0])) + 1
+    bounded = [[c if c <= max_cost else penalty for c in row] for row in cost]
+    return [(i, j) for i, j in hungarian(bounded) if cost[i][j] <= max_cost]
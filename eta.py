@@ -0,0 +1,138 @@
+import math
+import threading
+
+from geo import EARTH_RADIUS_KM, haversine_km
+
+# Straight-line distance understates the road route; this is a typical urban detour ratio
+ROAD_FACTOR = 1.3
+# Below this many pairs the pure-Python loop beats numpy's array setup
+NUMPY_MIN_BATCH = 64
+
+_numpy = None
+
+
+def _load_numpy():
+    """numpy, imported on first use so it stays off the boot path; None when not installed"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:  # numpy only speeds up large batches
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def haversine_many(lat1, lng1, lat2, lng2):
+    """Element-wise great-circle distances in km between two equal-length coordinate sequences"""
+    np = _load_numpy() if len(lat1) >= NUMPY_MIN_BATCH else None
+    if np is not None:
+        phi1 = np.radians(np.asarray(lat1, dtype=float))
+        phi2 = np.radians(np.asarray(lat2, dtype=float))
+        dphi = phi2 - phi1
+        dlmb = np.radians(np.asarray(lng2, dtype=float) - np.asarray(lng1, dtype=float))
+        a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlmb / 2) ** 2
+        return (2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(1.0, a)))).tolist()
+    return [haversine_km(a, b, c, d) for a, b, c, d in zip(lat1, lng1, lat2, lng2)]
+
+
+def distance_matrix(origins, targets):
+    """Road-adjusted km from every ``(lat, lng)`` origin to every target, as a list of rows"""
+    if not origins or not targets:
+        return [[] for _ in origins]
+    lat1 = [o[0] for o in origins for _ in targets]
+    lng1 = [o[1] for o in origins for _ in targets]
+    lat2 = [t[0] for t in targets] * len(origins)
+    lng2 = [t[1] for t in targets] * len(origins)
+    flat = [km * ROAD_FACTOR for km in haversine_many(lat1, lng1, lat2, lng2)]
+    width = len(targets)
+    return [flat[i:i + width] for i in range(0, len(flat), width)]
+
+
+class SpeedTracker:
+    """Rolling per-rider speed from consecutive GPS pings.
+
+    Speeds are smoothed with an exponential moving average. Pings too close in
+    time, implausibly fast jumps, and estimates older than ``stale_s`` are
+    ignored so a parked or glitching rider does not skew ETAs.
+    """
+
+    def __init__(self, alpha=0.3, min_interval_s=5, max_kmh=120, stale_s=600):
+        self.alpha = alpha
+        self.min_interval_s = min_interval_s
+        self.max_kmh = max_kmh
+        self.stale_s = stale_s
+        self._last = {}
+        self._speed = {}
+        self._lock = threading.Lock()
+
+    def observe(self, rider_id, lat, lng, timestamp):
+        with self._lock:
+            previous = self._last.get(rider_id)
+            if previous is not None:
+                plat, plng, pts = previous
+                elapsed = (timestamp - pts).total_seconds()
+                if elapsed < self.min_interval_s:
+                    return
+                kmh = haversine_km(plat, plng, lat, lng) / (elapsed / 3600)
+                if kmh <= self.max_kmh:
+                    speed = self._speed.get(rider_id)
+                    if speed is None or (timestamp - speed[1]).total_seconds() > self.stale_s:
+                        self._speed[rider_id] = (kmh, timestamp)
+                    else:
+                        self._speed[rider_id] = (self.alpha * kmh + (1 - self.alpha) * speed[0], timestamp)
+            self._last[rider_id] = (lat, lng, timestamp)
+
+    def speed_kmh(self, rider_id, now, default):
+        speed = self._speed.get(rider_id)
+        if speed is None or (now - speed[1]).total_seconds() > self.stale_s:
+            return default
+        return speed[0]
+
+
+def estimate_deliveries(deliveries, speeds, now, default_kmh, min_kmh=5):
+    """ETAs for many deliveries in one pass.
+
+    Each delivery is a dict with ``order_id``, ``rider_id``, ``picked_up`` and
+    ``rider``/``pickup``/``drop`` ``(lat, lng)`` tuples (any may be None).
+    Returns ``{order_id: {...}}`` with leg distances in km and minutes to
+    delivery, or None where the remaining route is unknown.
+    """
+    legs = []
+    for index, d in enumerate(deliveries):
+        rider, pickup, drop = d.get('rider'), d.get('pickup'), d.get('drop')
+        if d.get('picked_up') or pickup is None:
+            if rider and drop:
+                legs.append((index, 'to_drop', rider, drop))
+        else:
+            if rider:
+                legs.append((index, 'to_pickup', rider, pickup))
+            if drop:
+                legs.append((index, 'pickup_to_drop', pickup, drop))
+
+    distances = haversine_many(
+        [leg[2][0] for leg in legs], [leg[2][1] for leg in legs],
+        [leg[3][0] for leg in legs], [leg[3][1] for leg in legs]
+    ) if legs else []
+
+    results = {d['order_id']: {'to_pickup_km': None, 'pickup_to_drop_km': None, 'to_drop_km': None,
+                               'remaining_km': None, 'speed_kmh': None, 'eta_minutes': None}
+               for d in deliveries}
+    for (index, name, _, _), km in zip(legs, distances):
+        results[deliveries[index]['order_id']][f'{name}_km'] = round(km * ROAD_FACTOR, 2)
+
+    for d in deliveries:
+        result = results[d['order_id']]
+        if d.get('picked_up') or d.get('pickup') is None:
+            remaining = result['to_drop_km']
+        elif result['to_pickup_km'] is not None and result['pickup_to_drop_km'] is not None:
+            remaining = result['to_pickup_km'] + result['pickup_to_drop_km']
+        else:
+            remaining = None
+        if remaining is None or d.get('rider_id') is None:
+            continue
+        speed = max(min_kmh, speeds.speed_kmh(d['rider_id'], now, default_kmh))
+        result['remaining_km'] = round(remaining, 2)
+        result['speed_kmh'] = round(speed, 1)
+        result['eta_minutes'] = math.ceil(remaining / speed * 60)
+    return results
@@ -0,0 +1,231 @@
+import heapq
+import math
+import threading
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in kilometres"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _encode_value(value, out):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode_polyline(points, precision=5):
+    """Encode ``(lat, lng)`` pairs with the Google encoded polyline algorithm"""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lng = 0
+    for lat, lng in points:
+        ilat, ilng = int(round(lat * factor)), int(round(lng * factor))
+        _encode_value(ilat - prev_lat, out)
+        _encode_value(ilng - prev_lng, out)
+        prev_lat, prev_lng = ilat, ilng
+    return ''.join(out)
+
+
+def decode_polyline(encoded, precision=5):
+    """Inverse of ``encode_polyline``"""
+    factor = 10 ** precision
+    points = []
+    index = lat = lng = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / factor, lng / factor))
+    return points
+
+
+def simplify_track(points, tolerance_m):
+    """Indices of the ``(lat, lng)`` points kept by Douglas-Peucker at ``tolerance_m`` metres.
+
+    The first and last points are always kept. Distances use an equirectangular
+    projection around the first point, which is accurate at delivery scale.
+    """
+    n = len(points)
+    if n < 3 or tolerance_m <= 0:
+        return list(range(n))
+    ky = KM_PER_DEGREE * 1000
+    kx = ky * math.cos(math.radians(points[0][0]))
+    xy = [(lng * kx, lat * ky) for lat, lng in points]
+
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        ax, ay = xy[start]
+        dx, dy = xy[end][0] - ax, xy[end][1] - ay
+        length_sq = dx * dx + dy * dy
+        farthest, farthest_d = None, tolerance_m
+        for i in range(start + 1, end):
+            px, py = xy[i][0] - ax, xy[i][1] - ay
+            t = 0.0 if length_sq == 0 else max(0.0, min(1.0, (px * dx + py * dy) / length_sq))
+            d = math.hypot(px - t * dx, py - t * dy)
+            if d > farthest_d:
+                farthest, farthest_d = i, d
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((start, farthest))
+            stack.append((farthest, end))
+    return [i for i, kept in enumerate(keep) if kept]
+
+
+class RiderIndex:
+    """In-memory grid index over rider positions for k-nearest lookups.
+
+    Positions are bucketed into square cells of ``cell_deg`` degrees. A query
+    scans rings of cells outwards from the query cell and stops once no
+    unscanned cell can hold anything closer than the current k-th result.
+    """
+
+    def __init__(self, cell_deg=0.05):
+        self.cell_deg = cell_deg
+        self._cells = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, rider_id):
+        return rider_id in self._positions
+
+    def position(self, rider_id):
+        return self._positions.get(rider_id)
+
+    def update(self, rider_id, lat, lng):
+        if lat is None or lng is None:
+            self.remove(rider_id)
+            return
+        lat, lng = float(lat), float(lng)
+        cell = self._cell(lat, lng)
+        with self._lock:
+            previous = self._positions.get(rider_id)
+            if previous is not None:
+                old_cell = self._cell(*previous)
+                if old_cell != cell:
+                    self._discard(old_cell, rider_id)
+            self._cells.setdefault(cell, set()).add(rider_id)
+            self._positions[rider_id] = (lat, lng)
+
+    def remove(self, rider_id):
+        with self._lock:
+            previous = self._positions.pop(rider_id, None)
+            if previous is not None:
+                self._discard(self._cell(*previous), rider_id)
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self._positions.clear()
+
+    def rebuild(self, positions):
+        """Replace the index contents with ``(rider_id, lat, lng)`` rows in one swap"""
+        cells = {}
+        points = {}
+        for rider_id, lat, lng in positions:
+            if lat is None or lng is None:
+                continue
+            lat, lng = float(lat), float(lng)
+            cells.setdefault(self._cell(lat, lng), set()).add(rider_id)
+            points[rider_id] = (lat, lng)
+        with self._lock:
+            self._cells = cells
+            self._positions = points
+
+    def _discard(self, cell, rider_id):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(rider_id)
+            if not members:
+                del self._cells[cell]
+
+    def nearest(self, lat, lng, k=1, max_km=None, exclude=()):
+        """Return up to ``k`` ``(distance_km, rider_id)`` pairs, closest first"""
+        if k <= 0:
+            return []
+        lat, lng = float(lat), float(lng)
+        ci, cj = self._cell(lat, lng)
+        max_rings = None
+        if max_km is not None:
+            max_rings = int(max_km / (self.cell_deg * KM_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + 1, 89))), 0.01))) + 1
+
+        with self._lock:
+            if not self._positions:
+                return []
+            # Rings are bounded by the occupied extent so sparse fleets terminate quickly
+            extent = max(max(abs(i - ci), abs(j - cj)) for i, j in self._cells)
+            if max_rings is None or max_rings > extent:
+                max_rings = extent
+
+            best = []  # max-heap of (-distance, rider_id)
+
+            def consider(cell):
+                for rider_id in self._cells.get(cell, ()):
+                    if rider_id in exclude:
+                        continue
+                    rlat, rlng = self._positions[rider_id]
+                    distance = haversine_km(lat, lng, rlat, rlng)
+                    if max_km is not None and distance > max_km:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, rider_id))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, rider_id))
+
+            for ring in range(max_rings + 1):
+                if len(best) == k and ring > 1:
+                    # Any cell in this ring is at least (ring - 1) cells away on one axis
+                    edge_lat = min(abs(lat) + ring * self.cell_deg, 89)
+                    bound = (ring - 1) * self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(edge_lat))
+                    if bound > -best[0][0]:
+                        break
+                if 8 * ring > len(self._cells):
+                    # Perimeter is larger than the occupied set: finish with one pass over the rest
+                    for i, j in self._cells:
+                        if ring <= max(abs(i - ci), abs(j - cj)) <= max_rings:
+                            consider((i, j))
+                    break
+                for cell in self._ring_cells(ci, cj, ring):
+                    consider(cell)
+
+        return sorted((-d, rider_id) for d, rider_id in best)
+
+    def _ring_cells(self, ci, cj, ring):
+        if ring == 0:
+            yield (ci, cj)
+            return
+        for dj in range(-ring, ring + 1):
+            yield (ci - ring, cj + dj)
+            yield (ci + ring, cj + dj)
+        for di in range(-ring + 1, ring):
+            yield (ci + di, cj - ring)
+            yield (ci + di, cj + ring)
@@ -6,10 +6,18 @@ bind = "0.0.0.0:" + os.environ.get("PORT", "10000")
 backlog = 2048
 
 # Worker processes
-workers = 2  # Reduced for free tier
-worker_class = "sync"
-worker_connections = 1000
+# SocketIO websockets and long-polls are held open, so workers must be green-thread
+# (eventlet/gevent) or threaded; a sync worker serves one connection at a time.
+# Each async worker multiplexes up to `worker_connections` clients; post_fork makes
+# psycopg2 cooperative so queries yield instead of stalling them. Keep a single
+# worker unless SOCKETIO_MESSAGE_QUEUE is set so emits reach every process; with
+# several workers the load balancer must also use sticky sessions for long-polling.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "eventlet")
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 1000))
+threads = int(os.environ.get("GUNICORN_THREADS", 100 if worker_class == "gthread" else 1))
 timeout = 120
+graceful_timeout = 30
 keepalive = 2
 
 # Logging
@@ -28,9 +36,47 @@ user = None
 group = None
 tmp_upload_dir = None
 
+def socketio_async_mode(worker_class_str):
+    """The SocketIO async mode a gunicorn worker class can serve"""
+    name = worker_class_str.lower()
+    if "eventlet" in name:
+        return "eventlet"
+    if "gevent" in name:
+        return "gevent"
+    return "threading"
+
 # Server hooks
 def post_fork(server, worker):
     server.log.info("Worker spawned (pid: %s)", worker.pid)
+    mode = socketio_async_mode(worker.cfg.worker_class_str)
+    # Left to itself SocketIO picks eventlet whenever it is installed, even under gthread;
+    # the app is imported after this hook, so it reads the mode that matches the worker
+    os.environ.setdefault("SOCKETIO_ASYNC_MODE", mode)
+    # Monkey patching does not reach psycopg2's C-level socket I/O, so without a
+    # wait callback every PostgreSQL query blocks the whole green-thread worker
+    if mode in ("eventlet", "gevent"):
+        try:
+            if mode == "eventlet":
+                from psycogreen.eventlet import patch_psycopg
+            else:
+                from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            server.log.error("psycogreen is not installed; database queries will block the %s worker", mode)
+
+def post_worker_init(worker):
+    from app import socketio, start_background_tasks
+    expected = socketio_async_mode(worker.cfg.worker_class_str)
+    if socketio.async_mode != expected:
+        # A mismatched mode serves sockets from the wrong kind of thread and stalls the worker
+        raise RuntimeError(
+            f"SocketIO async mode {socketio.async_mode!r} does not match the "
+            f"{worker.cfg.worker_class_str} worker (expected {expected!r}); "
+            "fix SOCKETIO_ASYNC_MODE or GUNICORN_WORKER_CLASS"
+        )
+    # Dispatch, flushers and tickers run from boot, not from the first request after a deploy
+    start_background_tasks()
+    worker.log.info("Background tasks started (pid: %s)", worker.pid)
 
 def pre_fork(server, worker):
     pass
@@ -0,0 +1,82 @@
+import threading
+from datetime import datetime
+
+from geo import haversine_km
+
+
+class LocationBuffer:
+    """Collects rider GPS pings in memory until they are flushed in batches.
+
+    The latest position per rider is always kept. History rows for
+    ``UserLocation`` and ``OrderTracking`` are only kept when the rider has
+    moved at least ``min_distance_m`` or ``min_interval_s`` has passed since
+    the last kept point for the same rider/order.
+    """
+
+    def __init__(self, min_distance_m=0, min_interval_s=0, max_pending=5000):
+        self.min_distance_m = min_distance_m
+        self.min_interval_s = min_interval_s
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._locations = []
+        self._tracking = []
+        self._last_kept = {}
+
+    def __len__(self):
+        return len(self._locations) + len(self._tracking)
+
+    def _should_keep(self, key, lat, lng, timestamp):
+        previous = self._last_kept.get(key)
+        if previous is not None and (self.min_distance_m or self.min_interval_s):
+            plat, plng, pts = previous
+            moved_m = haversine_km(plat, plng, lat, lng) * 1000
+            elapsed_s = (timestamp - pts).total_seconds()
+            if moved_m < self.min_distance_m and elapsed_s < self.min_interval_s:
+                return False
+        self._last_kept[key] = (lat, lng, timestamp)
+        return True
+
+    def add(self, rider_id, lat, lng, accuracy=0, order_id=None, timestamp=None):
+        """Buffer one ping; returns True once the buffer should be flushed early"""
+        timestamp = timestamp or datetime.utcnow()
+        with self._lock:
+            self._latest[rider_id] = (lat, lng, timestamp)
+            if self._should_keep(('rider', rider_id), lat, lng, timestamp):
+                self._locations.append({
+                    'user_id': rider_id,
+                    'latitude': lat,
+                    'longitude': lng,
+                    'accuracy': accuracy,
+                    'timestamp': timestamp
+                })
+            if order_id and self._should_keep(('order', order_id), lat, lng, timestamp):
+                self._tracking.append({
+                    'order_id': order_id,
+                    'rider_lat': lat,
+                    'rider_lng': lng,
+                    'status': 'in_transit',
+                    'timestamp': timestamp
+                })
+            return len(self._locations) + len(self._tracking) >= self.max_pending
+
+    def latest(self, rider_id):
+        """Most recent unflushed ``(lat, lng, timestamp)`` for a rider, if any"""
+        return self._latest.get(rider_id)
+
+    def drain(self):
+        """Take everything buffered so far as ``(latest, locations, tracking)``"""
+        with self._lock:
+            latest, self._latest = self._latest, {}
+            locations, self._locations = self._locations, []
+            tracking, self._tracking = self._tracking, []
+            # Forget downsampling state for riders/orders that have gone quiet
+            if latest or tracking:
+                active = {('rider', rider_id) for rider_id in latest}
+                active.update(('order', row['order_id']) for row in tracking)
+                cutoff = datetime.utcnow()
+                self._last_kept = {
+                    key: value for key, value in self._last_kept.items()
+                    if key in active or (cutoff - value[2]).total_seconds() < 3600
+                }
+        return latest, locations, tracking
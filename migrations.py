@@ -0,0 +1,195 @@
+"""Versioned schema migrations for the marketplace database.
+
+Web workers never touch the schema on import; run this once per deploy
+instead (Procfile ``release``, or render.yaml ``startCommand`` since Render's
+``preDeployCommand`` is only available on paid instance types).
+
+    python migrations.py upgrade   apply pending migrations
+    python migrations.py upgrade --seed
+                                   apply pending migrations, then seed demo data
+    python migrations.py seed      create demo accounts/sample products if missing
+    python migrations.py status    list applied and pending migrations
+    python migrations.py bench     print query plans and timings for the hot queries
+
+Run ``bench`` before and after ``upgrade`` to compare plans.
+"""
+import sys
+import time
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from app import (app, db, logger, init_db, conversation_summaries,
+                 Product, Order, Sale, Message, OrderTracking, InventoryLog, Conversation)
+
+schema_metadata = sa.MetaData()
+schema_version = sa.Table(
+    'schema_version', schema_metadata,
+    sa.Column('version', sa.Integer, primary_key=True),
+    sa.Column('name', sa.String(100), nullable=False),
+    sa.Column('applied_at', sa.DateTime, nullable=False)
+)
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+def _create_indexes(conn, names):
+    indexes = {index.name: index for table in db.metadata.tables.values() for index in table.indexes}
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+
+@migration(1, 'baseline')
+def baseline(conn):
+    # Creates any missing tables; existing tables are left untouched
+    db.metadata.create_all(conn)
+
+
+@migration(2, 'hot_path_indexes')
+def hot_path_indexes(conn):
+    _create_indexes(conn, [
+        'ix_message_receiver_read',
+        'ix_message_pair_created',
+        'ix_sale_seller_date',
+        'ix_order_seller_created',
+        'ix_order_rider_status',
+        'ix_order_tracking_order_time',
+        'ix_inventory_log_seller_created',
+        'ix_product_active_category_created',
+    ])
+
+
+@migration(3, 'location_retention')
+def location_retention(conn):
+    db.metadata.tables['order_track_archive'].create(conn, checkfirst=True)
+    _create_indexes(conn, ['ix_user_location_user_time'])
+
+
+@migration(4, 'order_offered_at')
+def order_offered_at(conn):
+    if 'offered_at' in {column['name'] for column in sa.inspect(conn).get_columns('order')}:
+        return
+    table = conn.dialect.identifier_preparer.quote('order')
+    column_type = sa.DateTime().compile(dialect=conn.dialect)
+    conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN offered_at {column_type}')
+
+
+@migration(5, 'user_presence')
+def user_presence(conn):
+    db.metadata.tables['user_presence'].create(conn, checkfirst=True)
+
+
+@migration(6, 'conversation_backfill')
+def conversation_backfill(conn):
+    # Summaries for messages sent before the conversation table existed
+    rows = [row._asdict() for row in conn.execute(conversation_summaries())]
+    conn.execute(Conversation.__table__.delete())
+    if rows:
+        conn.execute(Conversation.__table__.insert(), rows)
+
+
+@migration(7, 'product_updated_at_index')
+def product_updated_at_index(conn):
+    # The search index refresh reads products changed since its last sync
+    _create_indexes(conn, ['ix_product_updated_at'])
+
+
+def applied_versions(conn):
+    schema_metadata.create_all(conn)
+    return {row.version for row in conn.execute(sa.select(schema_version.c.version))}
+
+
+def upgrade():
+    """Apply every pending migration, each in its own transaction"""
+    applied = 0
+    with app.app_context():
+        with db.engine.begin() as conn:
+            done = applied_versions(conn)
+        for version, name, fn in MIGRATIONS:
+            if version in done:
+                continue
+            with db.engine.begin() as conn:
+                fn(conn)
+                conn.execute(schema_version.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+            logger.info(f"✅ Applied migration {version:04d} {name}")
+            applied += 1
+    return applied
+
+
+def seed():
+    """Create demo accounts and sample products if missing"""
+    init_db()
+    logger.info("✅ Seed data up to date")
+
+
+def status():
+    with app.app_context(), db.engine.begin() as conn:
+        done = applied_versions(conn)
+    for version, name, _ in MIGRATIONS:
+        print(f"{version:04d} {name:<30} {'applied' if version in done else 'pending'}")
+
+
+def hot_queries():
+    """The query shapes the indexes above are meant to serve.
+
+    Only key and indexed columns are selected, so ``bench`` also runs against a
+    database whose tables predate columns added by later migrations.
+    """
+    since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return [
+        ('unread messages', sa.select(sa.func.count(Message.id)).where(Message.receiver_id == 1, Message.is_read == False)),
+        ('conversation history', sa.select(Message.id, Message.created_at).where(
+            ((Message.sender_id == 1) & (Message.receiver_id == 2)) |
+            ((Message.sender_id == 2) & (Message.receiver_id == 1))
+        ).order_by(Message.created_at.desc()).limit(50)),
+        ("seller today's sales", sa.select(sa.func.sum(Sale.total_price)).where(Sale.seller_id == 1, Sale.sale_date >= since)),
+        ('seller recent orders', sa.select(Order.id, Order.created_at).where(Order.seller_id == 1).order_by(Order.created_at.desc()).limit(10)),
+        ('rider deliveries by status', sa.select(Order.id, Order.status).where(Order.rider_id == 1, Order.status == 'in_transit')),
+        ('order tracking replay', sa.select(OrderTracking.id, OrderTracking.timestamp).where(OrderTracking.order_id == 1).order_by(OrderTracking.timestamp)),
+        ('inventory log', sa.select(InventoryLog.id, InventoryLog.created_at).where(InventoryLog.seller_id == 1).order_by(InventoryLog.created_at.desc()).limit(50)),
+        ('search index refresh', sa.select(Product.id, Product.updated_at).where(Product.updated_at >= since)),
+        ('catalog by category', sa.select(Product.id, Product.created_at).where(Product.is_active == True, Product.category == 'Fruits').order_by(Product.created_at.desc()).limit(24)),
+    ]
+
+
+def bench(runs=20):
+    """Print the plan and mean execution time of each hot query"""
+    with app.app_context(), db.engine.connect() as conn:
+        dialect = conn.dialect.name
+        explain = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+        for label, stmt in hot_queries():
+            compiled = stmt.compile(dialect=conn.dialect)
+            params = tuple(compiled.params[name] for name in compiled.positiontup) if compiled.positional else compiled.params
+            plan = conn.exec_driver_sql(explain + str(compiled), params).fetchall()
+            started = time.perf_counter()
+            for _ in range(runs):
+                conn.execute(stmt).fetchall()
+            elapsed_ms = (time.perf_counter() - started) * 1000 / runs
+            print(f"== {label} ({elapsed_ms:.3f} ms)")
+            for row in plan:
+                print('   ', row[-1])
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    if command == 'upgrade':
+        print(f"Applied {upgrade()} migration(s)")
+        if '--seed' in sys.argv[2:]:
+            seed()
+    elif command == 'seed':
+        seed()
+    elif command == 'status':
+        status()
+    elif command == 'bench':
+        bench()
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,105 @@
+import threading
+import time
+from datetime import datetime
+
+
+class PresenceRegistry:
+    """Who is online, kept in memory instead of written on every socket event.
+
+    Each worker tracks its own socket sessions per user, so a user with several
+    tabs stays online until the last one closes. Sessions that stop sending
+    heartbeats for ``ttl`` seconds are expired. Users connected to other workers
+    come from a snapshot of those workers' sessions loaded with ``set_remote``,
+    so a user is online while any worker holds a session; the local state is
+    written back in batches through ``drain``.
+    """
+
+    def __init__(self, ttl=90):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._roles = {}
+        self._dirty = {}
+        self._remote = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def connect(self, user_id, sid, role=None):
+        """Register a socket session; returns True if the user just came online here"""
+        with self._lock:
+            sessions = self._sessions.setdefault(user_id, {})
+            first = not sessions
+            sessions[sid] = time.monotonic()
+            if role:
+                self._roles[user_id] = role
+            self._dirty[user_id] = (True, datetime.utcnow())
+            return first
+
+    def disconnect(self, user_id, sid):
+        """Drop a socket session; returns True if it was the user's last one here"""
+        with self._lock:
+            return self._drop(user_id, sid)
+
+    def _drop(self, user_id, sid):
+        sessions = self._sessions.get(user_id)
+        if not sessions or sessions.pop(sid, None) is None:
+            return False
+        if sessions:
+            return False
+        del self._sessions[user_id]
+        self._roles.pop(user_id, None)
+        self._dirty[user_id] = (False, datetime.utcnow())
+        return True
+
+    def heartbeat(self, user_id, sid):
+        with self._lock:
+            sessions = self._sessions.get(user_id)
+            if sessions is not None and sid in sessions:
+                sessions[sid] = time.monotonic()
+
+    def expire(self, alive=None):
+        """Drop sessions without a recent heartbeat; returns users that went offline.
+
+        ``alive(sid)`` may vouch for a session the server still holds open,
+        which counts as a heartbeat.
+        """
+        now = time.monotonic()
+        cutoff = now - self.ttl
+        offline = []
+        with self._lock:
+            for user_id, sessions in list(self._sessions.items()):
+                for sid, seen in list(sessions.items()):
+                    if alive is not None and alive(sid):
+                        sessions[sid] = now
+                    elif seen < cutoff and self._drop(user_id, sid):
+                        offline.append(user_id)
+        return offline
+
+    def is_online(self, user_id):
+        with self._lock:
+            return user_id in self._sessions or user_id in self._remote
+
+    def online_ids(self, role=None):
+        with self._lock:
+            local = {user_id for user_id in self._sessions if role is None or self._roles.get(user_id) == role}
+            remote = {user_id for user_id, r in self._remote.items() if role is None or r == role}
+            return local | remote
+
+    def set_remote(self, users):
+        """Replace the snapshot of users held by other workers with a ``{user_id: role}`` mapping"""
+        with self._lock:
+            self._remote = dict(users)
+
+    def drain(self):
+        """Rows to write back as ``{user_id: (connected_here, last_seen)}``.
+
+        Every locally connected user is included so their ``last_seen`` keeps
+        other workers from treating them as expired.
+        """
+        now = datetime.utcnow()
+        with self._lock:
+            rows, self._dirty = self._dirty, {}
+            for user_id in self._sessions:
+                rows[user_id] = (True, now)
+        return rows
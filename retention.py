@@ -0,0 +1,207 @@
+"""Compaction and retention for rider location history.
+
+    python retention.py run            archive finished order tracks, thin and expire location history
+    python retention.py run --vacuum   then VACUUM (ANALYZE) both tables on PostgreSQL
+    python retention.py run --full     thin all retained history, not just the newest window
+    python retention.py status         row counts and what the next run would touch
+
+Run daily; render.yaml schedules it as a cron job. Settings:
+
+    TRACK_ARCHIVE_AFTER_HOURS   archive a finished order's track this long after it ends (24)
+    TRACK_TOLERANCE_M           Douglas-Peucker tolerance for archived tracks (10)
+    TRACKING_RETENTION_DAYS     archive any order's track this old, finished or not (90)
+    LOCATION_THIN_AFTER_DAYS    thin UserLocation history older than this (7)
+    LOCATION_TOLERANCE_M        Douglas-Peucker tolerance for thinned history (25)
+    LOCATION_THIN_WINDOW_DAYS   days of newly eligible history thinned per run (3)
+    LOCATION_RETENTION_DAYS     delete UserLocation rows older than this (90)
+    RETENTION_BATCH_SIZE        rows deleted per transaction (5000)
+"""
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+from app import (
+    app, db, logger, summarize_track,
+    Order, OrderTracking, OrderTrackArchive, UserLocation
+)
+from geo import decode_polyline, encode_polyline, simplify_track
+
+TRACK_ARCHIVE_AFTER_HOURS = float(os.environ.get('TRACK_ARCHIVE_AFTER_HOURS', 24))
+TRACK_TOLERANCE_M = float(os.environ.get('TRACK_TOLERANCE_M', 10))
+TRACKING_RETENTION_DAYS = float(os.environ.get('TRACKING_RETENTION_DAYS', 90))
+LOCATION_THIN_AFTER_DAYS = float(os.environ.get('LOCATION_THIN_AFTER_DAYS', 7))
+LOCATION_TOLERANCE_M = float(os.environ.get('LOCATION_TOLERANCE_M', 25))
+LOCATION_THIN_WINDOW_DAYS = float(os.environ.get('LOCATION_THIN_WINDOW_DAYS', 3))
+LOCATION_RETENTION_DAYS = float(os.environ.get('LOCATION_RETENTION_DAYS', 90))
+BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', 5000))
+
+FINISHED_STATUSES = ('completed', 'delivered', 'cancelled')
+TRACKING_COLUMNS = (
+    OrderTracking.id, OrderTracking.rider_lat, OrderTracking.rider_lng,
+    OrderTracking.status, OrderTracking.message, OrderTracking.timestamp
+)
+
+
+def _delete_ids(model, ids):
+    for i in range(0, len(ids), BATCH_SIZE):
+        db.session.query(model).filter(model.id.in_(ids[i:i + BATCH_SIZE])).delete(synchronize_session=False)
+        db.session.commit()
+    return len(ids)
+
+
+def _is_tracking_event(row):
+    return bool(row.message) or row.status != 'in_transit'
+
+
+def _thin(rows, tolerance_m, is_event=None):
+    """Simplify ``(id, lat, lng, ...)`` rows, always keeping unpositioned rows and ``is_event`` rows"""
+    positioned = [i for i, row in enumerate(rows) if row[1] is not None and row[2] is not None]
+    kept = {positioned[i] for i in simplify_track([(rows[j][1], rows[j][2]) for j in positioned], tolerance_m)}
+    kept.update(set(range(len(rows))) - set(positioned))
+    if is_event is not None:
+        kept.update(i for i, row in enumerate(rows) if is_event(row))
+    return [rows[i] for i in sorted(kept)]
+
+
+def archivable_orders(now):
+    finished_before = now - timedelta(hours=TRACK_ARCHIVE_AFTER_HOURS)
+    any_before = now - timedelta(days=TRACKING_RETENTION_DAYS)
+    ended_at = db.func.coalesce(Order.completed_at, Order.created_at)
+    return [order_id for (order_id,) in db.session.query(Order.id).filter(
+        Order.id.in_(db.select(OrderTracking.order_id).distinct()),
+        (Order.status.in_(FINISHED_STATUSES) & (ended_at < finished_before)) | (Order.created_at < any_before)
+    ).all()]
+
+
+def archive_order_track(order_id):
+    """Replace an order's tracking rows with one thinned, polyline-encoded archive row"""
+    rows = db.session.query(*TRACKING_COLUMNS).filter(
+        OrderTracking.order_id == order_id
+    ).order_by(OrderTracking.timestamp, OrderTracking.id).all()
+    if not rows:
+        return 0
+    points, offsets, events, start = summarize_track(_thin(rows, TRACK_TOLERANCE_M, _is_tracking_event))
+    point_count = sum(1 for row in rows if row.rider_lat is not None and row.rider_lng is not None)
+
+    archive = OrderTrackArchive.query.filter_by(order_id=order_id).first()
+    if archive is None:
+        archive = OrderTrackArchive(order_id=order_id, started_at=start)
+        db.session.add(archive)
+    else:
+        # Rows flushed after an earlier archive run are appended to it
+        previous = decode_polyline(archive.polyline)
+        previous_offsets = json.loads(archive.offsets)
+        if points and previous and archive.ended_at:
+            offsets[0] = round((start - archive.ended_at).total_seconds())
+        for event in events:
+            event['point'] += len(previous)
+        points = previous + points
+        offsets = previous_offsets + offsets
+        events = json.loads(archive.events) + events
+        point_count += archive.point_count
+        archive.started_at = archive.started_at or start
+
+    archive.polyline = encode_polyline(points)
+    archive.offsets = json.dumps(offsets)
+    archive.events = json.dumps(events)
+    archive.point_count = point_count
+    archive.ended_at = max([row.timestamp for row in rows if row.timestamp] + [archive.ended_at or datetime.min])
+    archive.archived_at = datetime.utcnow()
+    db.session.query(OrderTracking).filter(OrderTracking.order_id == order_id).delete(synchronize_session=False)
+    db.session.commit()
+    return len(rows)
+
+
+def thin_user_locations(now, full=False):
+    """Douglas-Peucker thin each rider's history one day at a time; returns rows deleted"""
+    thin_before = now - timedelta(days=LOCATION_THIN_AFTER_DAYS)
+    thin_from = now - timedelta(days=LOCATION_RETENTION_DAYS)
+    if not full:
+        # Older days were thinned by earlier runs
+        thin_from = max(thin_from, thin_before - timedelta(days=LOCATION_THIN_WINDOW_DAYS))
+    deleted = 0
+    for (user_id,) in db.session.query(UserLocation.user_id).distinct().all():
+        day_start = thin_from
+        while day_start < thin_before:
+            day_end = min(day_start + timedelta(days=1), thin_before)
+            rows = db.session.query(
+                UserLocation.id, UserLocation.latitude, UserLocation.longitude
+            ).filter(
+                UserLocation.user_id == user_id,
+                UserLocation.timestamp >= day_start,
+                UserLocation.timestamp < day_end
+            ).order_by(UserLocation.timestamp, UserLocation.id).all()
+            if len(rows) > 2:
+                kept = {row.id for row in _thin(rows, LOCATION_TOLERANCE_M)}
+                deleted += _delete_ids(UserLocation, [row.id for row in rows if row.id not in kept])
+            day_start = day_end
+    return deleted
+
+
+def expire_user_locations(now):
+    """Delete location history past retention, per rider so each delete uses the index"""
+    keep_from = now - timedelta(days=LOCATION_RETENTION_DAYS)
+    deleted = 0
+    for (user_id,) in db.session.query(UserLocation.user_id).distinct().all():
+        while True:
+            ids = [row_id for (row_id,) in db.session.query(UserLocation.id).filter(
+                UserLocation.user_id == user_id,
+                UserLocation.timestamp < keep_from
+            ).limit(BATCH_SIZE).all()]
+            if not ids:
+                break
+            deleted += _delete_ids(UserLocation, ids)
+    return deleted
+
+
+def vacuum():
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if conn.dialect.name != 'postgresql':
+            logger.info(f"Skipping VACUUM on {conn.dialect.name}")
+            return
+        for table in (UserLocation.__tablename__, OrderTracking.__tablename__):
+            conn.exec_driver_sql(f'VACUUM (ANALYZE) {table}')
+
+
+def run(with_vacuum=False, full=False):
+    now = datetime.utcnow()
+    with app.app_context():
+        orders = archivable_orders(now)
+        archived_rows = 0
+        for order_id in orders:
+            try:
+                archived_rows += archive_order_track(order_id)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Track archive error for order {order_id}: {e}")
+        thinned = thin_user_locations(now, full)
+        expired = expire_user_locations(now)
+        if with_vacuum:
+            vacuum()
+    logger.info(f"✅ Archived {archived_rows} tracking rows from {len(orders)} orders, "
+                f"thinned {thinned} and expired {expired} location rows")
+    return {'orders_archived': len(orders), 'tracking_rows_archived': archived_rows,
+            'locations_thinned': thinned, 'locations_expired': expired}
+
+
+def status():
+    now = datetime.utcnow()
+    with app.app_context():
+        print(f"order_tracking rows      {OrderTracking.query.count()}")
+        print(f"order_track_archive rows {OrderTrackArchive.query.count()}")
+        print(f"user_location rows       {UserLocation.query.count()}")
+        print(f"orders ready to archive  {len(archivable_orders(now))}")
+        print(f"locations past retention "
+              f"{UserLocation.query.filter(UserLocation.timestamp < now - timedelta(days=LOCATION_RETENTION_DAYS)).count()}")
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    if command == 'run':
+        print(json.dumps(run(with_vacuum='--vacuum' in sys.argv[2:], full='--full' in sys.argv[2:])))
+    elif command == 'status':
+        status()
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,137 @@
+import bisect
+import math
+import re
+import threading
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is',
+    'it', 'of', 'on', 'or', 'the', 'to', 'with'
+}
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+class InvertedIndex:
+    """In-memory full-text index with weighted fields and prefix matching.
+
+    Every query term must match (AND). Each term matches indexed terms that
+    start with it; exact matches score higher than prefix matches. Scores are
+    field-weighted term frequency times inverse document frequency.
+    """
+
+    def __init__(self, field_weights):
+        self.field_weights = field_weights
+        self._postings = {}
+        self._docs = {}
+        self._meta = {}
+        self._terms = []
+        self._terms_dirty = False
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._docs
+
+    def meta(self, doc_id):
+        return self._meta.get(doc_id)
+
+    def ids(self):
+        with self._lock:
+            return set(self._docs)
+
+    def add(self, doc_id, fields, **meta):
+        """Index (or re-index) a document from a mapping of field name to text"""
+        weights = {}
+        for field, text in fields.items():
+            weight = self.field_weights.get(field, 1.0)
+            for token in tokenize(text):
+                weights[token] = weights.get(token, 0.0) + weight
+        with self._lock:
+            self._remove(doc_id)
+            for token, weight in weights.items():
+                postings = self._postings.get(token)
+                if postings is None:
+                    postings = self._postings[token] = {}
+                    self._terms_dirty = True
+                postings[doc_id] = weight
+            self._docs[doc_id] = tuple(weights)
+            self._meta[doc_id] = meta
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        for token in self._docs.pop(doc_id, ()):
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[token]
+                    self._terms_dirty = True
+        self._meta.pop(doc_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._docs.clear()
+            self._meta.clear()
+            self._terms = []
+            self._terms_dirty = False
+
+    def _expand(self, token):
+        if self._terms_dirty:
+            self._terms = sorted(self._postings)
+            self._terms_dirty = False
+        start = bisect.bisect_left(self._terms, token)
+        end = bisect.bisect_left(self._terms, token + '￿')
+        return self._terms[start:end]
+
+    def search(self, query, limit=20, offset=0, where=None):
+        """Return ``(total, [doc_id, ...])`` for one page of ranked matches.
+
+        ``where`` is an optional predicate over a document's metadata dict.
+        """
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return 0, []
+        with self._lock:
+            total_docs = len(self._docs) or 1
+            scores = None
+            for token in tokens:
+                token_scores = {}
+                for term in self._expand(token):
+                    postings = self._postings[term]
+                    idf = math.log(1 + total_docs / len(postings))
+                    boost = 1.0 if term == token else 0.5
+                    for doc_id, weight in postings.items():
+                        score = weight * idf * boost
+                        if score > token_scores.get(doc_id, 0.0):
+                            token_scores[doc_id] = score
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {doc_id: scores[doc_id] + s for doc_id, s in token_scores.items() if doc_id in scores}
+                if not scores:
+                    return 0, []
+
+            if where is not None:
+                scores = {doc_id: s for doc_id, s in scores.items() if where(self._meta[doc_id])}
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], -self._rank_key(item[0])))
+        return len(ranked), [doc_id for doc_id, _ in ranked[offset:offset + limit]]
+
+    def _rank_key(self, doc_id):
+        # Ties go to the newest document
+        return self._meta[doc_id].get('sort_key', 0)
+
+    def values(self, field):
+        """Distinct non-empty values of a metadata field across indexed documents"""
+        with self._lock:
+            return sorted({meta.get(field) for meta in self._meta.values() if meta.get(field)})
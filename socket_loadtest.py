@@ -0,0 +1,142 @@
+"""Concurrent SocketIO load test against a running server.
+
+    python socket_loadtest.py --url http://localhost:10000 --clients 500 \\
+        --username buyer1 --password buyer123 --order-id 1 \\
+        --rider-username rider1 --rider-password rider123 --pings 20
+
+Opens ``--clients`` sockets sharing one logged-in session, joins each to the
+order's tracking room, then has the rider post location pings and measures
+how many reach every socket and how fast. Run it against a single worker to
+see how many concurrent sockets one worker sustains. Install websocket-client
+to exercise the websocket transport; otherwise clients fall back to long-polling.
+Point ``--post-url`` at a different worker to check cross-process fan-out.
+"""
+import argparse
+import statistics
+import threading
+import time
+
+import requests
+import socketio
+
+
+def login(url, username, password):
+    http = requests.Session()
+    response = http.post(f"{url}/login", data={'username': username, 'password': password}, allow_redirects=False)
+    if 'session' not in http.cookies:
+        raise SystemExit(f"Login failed for {username} (HTTP {response.status_code})")
+    return http
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarize(label, seconds):
+    ms = [s * 1000 for s in seconds]
+    if not ms:
+        print(f"{label:<22} no samples")
+        return
+    print(f"{label:<22} n={len(ms):<6} p50={percentile(ms, 50):8.1f} ms  "
+          f"p95={percentile(ms, 95):8.1f} ms  max={max(ms):8.1f} ms  mean={statistics.mean(ms):8.1f} ms")
+
+
+class LoadClient:
+    def __init__(self, url, cookie, order_id, results):
+        self.url = url
+        self.cookie = cookie
+        self.order_id = order_id
+        self.results = results
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on(f'order_{order_id}_location', self.on_location)
+
+    def on_location(self, data):
+        sent_at = self.results['sent'].get((data['lat'], data['lng']))
+        if sent_at is not None:
+            with self.results['lock']:
+                self.results['delivery'].append(time.perf_counter() - sent_at)
+
+    def run(self, ready):
+        try:
+            started = time.perf_counter()
+            self.sio.connect(self.url, headers={'Cookie': f'session={self.cookie}'}, wait_timeout=30)
+            connected = time.perf_counter()
+            self.sio.call('track_order', {'order_id': self.order_id}, timeout=30)
+            joined = time.perf_counter()
+            with self.results['lock']:
+                self.results['connect'].append(connected - started)
+                self.results['join'].append(joined - connected)
+        except Exception as e:
+            with self.results['lock']:
+                self.results['errors'].append(str(e))
+        finally:
+            ready.release()
+
+    def close(self):
+        if self.sio.connected:
+            self.sio.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:10000')
+    parser.add_argument('--post-url', help='where the rider posts pings (defaults to --url)')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds between client connects')
+    parser.add_argument('--username', default='buyer1')
+    parser.add_argument('--password', default='buyer123')
+    parser.add_argument('--order-id', type=int, default=1)
+    parser.add_argument('--rider-username', default='rider1')
+    parser.add_argument('--rider-password', default='rider123')
+    parser.add_argument('--pings', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between rider pings')
+    parser.add_argument('--hold', type=float, default=2.0, help='seconds to wait for the last deliveries')
+    args = parser.parse_args()
+
+    cookie = login(args.url, args.username, args.password).cookies['session']
+    results = {'lock': threading.Lock(), 'connect': [], 'join': [], 'delivery': [], 'errors': [], 'sent': {}}
+
+    clients = [LoadClient(args.url, cookie, args.order_id, results) for _ in range(args.clients)]
+    ready = threading.Semaphore(0)
+    started = time.perf_counter()
+    for client in clients:
+        threading.Thread(target=client.run, args=(ready,), daemon=True).start()
+        if args.ramp:
+            time.sleep(args.ramp)
+    for _ in clients:
+        ready.acquire()
+    connected = len(results['connect'])
+    print(f"Connected {connected}/{args.clients} sockets in {time.perf_counter() - started:.1f}s")
+
+    if connected and args.pings:
+        post_url = args.post_url or args.url
+        rider = login(post_url, args.rider_username, args.rider_password)
+        post_times = []
+        for i in range(args.pings):
+            lat, lng = -1.28 + i * 1e-4, 36.82 + i * 1e-4
+            results['sent'][(lat, lng)] = time.perf_counter()
+            sent = time.perf_counter()
+            rider.post(f"{post_url}/rider/update-location", json={'lat': lat, 'lng': lng, 'order_id': args.order_id})
+            post_times.append(time.perf_counter() - sent)
+            time.sleep(args.interval)
+        time.sleep(args.hold)
+        expected = connected * args.pings
+        print(f"Delivered {len(results['delivery'])}/{expected} location events "
+              f"({100 * len(results['delivery']) / expected:.1f}%)")
+        summarize('location POST', post_times)
+
+    summarize('socket connect', results['connect'])
+    summarize('join ack round trip', results['join'])
+    summarize('fan-out delivery', results['delivery'])
+    if results['errors']:
+        print(f"{len(results['errors'])} client error(s), first: {results['errors'][0]}")
+
+    for client in clients:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
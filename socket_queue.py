@@ -0,0 +1,181 @@
+"""Cross-process SocketIO fan-out backends.
+
+``SOCKETIO_MESSAGE_QUEUE`` selects how emits reach clients held by other
+worker processes:
+
+    redis://host:6379/0          Redis or any Redis-compatible server (needs ``redis``)
+    amqp://... and other kombu   RabbitMQ etc. through kombu (needs ``kombu``)
+    postgresql://user@host/db    PostgreSQL LISTEN/NOTIFY on the existing database
+    file:///tmp/socketio.queue   append-only local file, for multi-worker testing on one host
+
+Unset means emits stay inside the current process.
+"""
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+import socketio
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL rejects NOTIFY payloads of 8000 bytes or more
+PG_NOTIFY_MAX_BYTES = 7999
+# An idle LISTEN connection is probed this often so a dead one is replaced
+LISTEN_PING_SECONDS = 30
+
+
+class PostgresNotifyManager(socketio.PubSubManager):
+    """Fan-out over PostgreSQL ``NOTIFY``/``LISTEN``; no extra service to run"""
+
+    name = 'postgres'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.url = url
+        self._publish_conn = None
+        self._publish_lock = threading.Lock()
+
+    def _async_mode(self):
+        return getattr(self.server, 'async_mode', None) or 'threading'
+
+    def _connect(self):
+        import psycopg2
+        import psycopg2.extensions
+        mode = self._async_mode()
+        if mode != 'threading' and psycopg2.extensions.get_wait_callback() is None:
+            # Without a wait callback psycopg2 blocks the green-thread hub on every call
+            if mode == 'eventlet':
+                from psycogreen.eventlet import patch_psycopg
+            else:
+                from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        # TCP keepalives surface a silently dropped LISTEN connection as an error
+        conn = psycopg2.connect(self.url, keepalives=1, keepalives_idle=30,
+                                keepalives_interval=10, keepalives_count=3)
+        conn.autocommit = True
+        return conn
+
+    def _wait_readable(self, conn, timeout):
+        """Wait for notifications without blocking other green threads"""
+        mode = self._async_mode()
+        if mode == 'eventlet':
+            from eventlet.green import select as green_select
+            return bool(green_select.select([conn], [], [], timeout)[0])
+        if mode.startswith('gevent'):
+            from gevent import select as green_select
+            return bool(green_select.select([conn], [], [], timeout)[0])
+        return bool(select.select([conn], [], [], timeout)[0])
+
+    def _publish(self, data):
+        payload = json.dumps(data)
+        if len(payload.encode('utf-8')) > PG_NOTIFY_MAX_BYTES:
+            logger.error(f"SocketIO message too large for NOTIFY ({len(payload)} bytes), dropped")
+            return
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publish_conn is None or self._publish_conn.closed:
+                        self._publish_conn = self._connect()
+                    with self._publish_conn.cursor() as cur:
+                        cur.execute('SELECT pg_notify(%s, %s)', (self.channel, payload))
+                    return
+                except Exception as e:
+                    self._publish_conn = None
+                    if attempt:
+                        logger.error(f"SocketIO NOTIFY error: {e}")
+
+    def _listen(self):
+        retry_sleep = 1
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                with conn.cursor() as cur:
+                    cur.execute('LISTEN "{}"'.format(self.channel.replace('"', '""')))
+                if retry_sleep > 1:
+                    logger.info("SocketIO LISTEN reconnected; emits sent while it was down were missed")
+                retry_sleep = 1
+                idle_since = time.monotonic()
+                while True:
+                    if self._wait_readable(conn, 5):
+                        conn.poll()
+                        idle_since = time.monotonic()
+                        while conn.notifies:
+                            yield conn.notifies.pop(0).payload
+                    elif time.monotonic() - idle_since > LISTEN_PING_SECONDS:
+                        # A quiet channel looks the same as a dead connection until we use it
+                        with conn.cursor() as cur:
+                            cur.execute('SELECT 1')
+                        idle_since = time.monotonic()
+            except Exception as e:
+                logger.error(f"SocketIO LISTEN error, reconnecting in {retry_sleep}s: {e}")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                self.server.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 60)
+
+
+class FileQueueManager(socketio.PubSubManager):
+    """Fan-out through an append-only file shared by workers on one host.
+
+    Meant for exercising multi-worker behaviour locally without a broker; the
+    file is never compacted, so do not use it in production.
+    """
+
+    name = 'file'
+
+    def __init__(self, path, channel='flask-socketio', write_only=False, logger=None, poll_interval=0.05):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.poll_interval = poll_interval
+
+    def _publish(self, data):
+        line = (json.dumps({'channel': self.channel, 'data': data}) + '\n').encode('utf-8')
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            # A single O_APPEND write keeps lines from different workers intact
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def _listen(self):
+        open(self.path, 'a').close()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            f.seek(0, os.SEEK_END)
+            pending = ''
+            while True:
+                chunk = f.readline()
+                if not chunk:
+                    if os.path.getsize(self.path) < f.tell():
+                        f.seek(0)
+                        pending = ''
+                    self.server.sleep(self.poll_interval)
+                    continue
+                pending += chunk
+                if not pending.endswith('\n'):
+                    continue
+                try:
+                    message = json.loads(pending)
+                except ValueError:
+                    message = {}
+                pending = ''
+                if message.get('channel') == self.channel:
+                    yield message['data']
+
+
+def message_queue_options(url, channel='flask-socketio', write_only=False):
+    """Keyword arguments for ``SocketIO(...)`` that enable the configured backend"""
+    if not url:
+        return {}
+    if url.startswith(('postgres://', 'postgresql://')):
+        return {'client_manager': PostgresNotifyManager(url, channel=channel, write_only=write_only)}
+    if url.startswith('file://'):
+        return {'client_manager': FileQueueManager(url[len('file://'):], channel=channel, write_only=write_only)}
+    # Redis, Kafka, ZeroMQ and kombu URLs are handled by Flask-SocketIO itself
+    return {'message_queue': url, 'channel': channel}
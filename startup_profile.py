@@ -0,0 +1,76 @@
+"""Report where worker boot time goes when importing the app.
+
+    python startup_profile.py            profile `import app`
+    python startup_profile.py --top 30   show more rows
+    python startup_profile.py gunicorn_config
+
+Runs the import in a fresh interpreter with ``-X importtime`` and sums the
+self time of every module under its top-level package, so a slow dependency
+shows up as one line instead of hundreds.
+"""
+import os
+import subprocess
+import sys
+import time
+
+
+def profile_import(module='app'):
+    """Return ``(wall_seconds, [(self_us, cumulative_us, name), ...])`` for one cold import"""
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(self_us), int(cumulative_us), name.strip()))
+    return wall, rows
+
+
+def by_package(rows):
+    totals = {}
+    for self_us, _, name in rows:
+        package = name.split('.')[0]
+        count, total = totals.get(package, (0, 0))
+        totals[package] = (count + 1, total + self_us)
+    return sorted(totals.items(), key=lambda item: -item[1][1])
+
+
+def main(argv):
+    top = 20
+    module = 'app'
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == '--top':
+            top = int(args.pop(0))
+        else:
+            module = arg
+
+    wall, rows = profile_import(module)
+    own = next((self_us for self_us, _, name in rows if name == module), 0)
+    imported = sum(self_us for self_us, _, _ in rows)
+
+    print(f"import {module}: {wall * 1000:.0f} ms wall (interpreter start included), "
+          f"{imported / 1000:.0f} ms in {len(rows)} module(s), {own / 1000:.0f} ms in {module} itself")
+    print()
+    print(f"{'package':<32} {'modules':>7} {'ms':>9}")
+    for package, (count, total) in by_package(rows)[:top]:
+        print(f"{package:<32} {count:>7} {total / 1000:>9.1f}")
+    print()
+    print(f"{'slowest modules (self)':<56} {'ms':>9}")
+    for self_us, _, name in sorted(rows, reverse=True)[:top]:
+        print(f"{name:<56} {self_us / 1000:>9.1f}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])